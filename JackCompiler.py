@@ -1,113 +1,77 @@
-import os, sys
+import os, sys, io, re
 import xml.etree.ElementTree as ET
 from xml.dom import minidom
 import pprint
 
+class Token:
+    # one token of a .jack file, classified when the file is tokenized so that the Tokenizer's accessors only read
+    # these fields
+    __slots__ = ('type', 'value', 'line', 'column')
+
+    def __init__(self, type, value, line, column):
+        self.type = type     # KEYWORD, SYMBOL, INT_CONST, STRING_CONST or IDENTIFIER
+        self.value = value   # the token's text, string constants with their quotes
+        self.line = line
+        self.column = column
+
 class Tokenizer: 
     #breks input from a single .jack input file into Jack-language tokens as specified by the Jack grammar
+    keywords = frozenset(('class', 'constructor', 'function', 'method', 'field', 'static', 'var', 'int', 'char',
+                          'boolean', 'void', 'true', 'false', 'null', 'this', 'let', 'do', 'if', 'else', 'while',
+                          'return'))
+
+    # one alternative per kind of lexical element, tried in this order at every position. comments come before
+    # the symbols so that / starts a comment when it can, and anything no other alternative matches is an error
+    token_pattern = re.compile(r"""
+          (?P<COMMENT>//[^\n]*|/\*.*?\*/)
+        | (?P<SPACE>\s+)
+        | (?P<INT_CONST>\d+)
+        | (?P<STRING_CONST>"[^"\n]*")
+        | (?P<WORD>[A-Za-z_]\w*)
+        | (?P<UNCLOSED_COMMENT>/\*)
+        | (?P<SYMBOL>[{}()\[\].,;+\-*/&|<>=~])
+        | (?P<ERROR>.)
+        """, re.VERBOSE | re.DOTALL)
+
     def __init__(self, infilename):
-        # opens input file and gets ready to parse it
+        # opens input file and gets ready to parse it. the whole file is scanned once with token_pattern and every
+        # token is kept as a Token
         self.infilename = infilename
-        self.infile = []
+        self.tokens = []
 
-        # cleaning up any single comments and empty lines in the input file and storing each line in an array
         infile = open(self.infilename + '.jack')
-        for line in infile:
-
-            line = line.strip()
-            comment = line.find('//')
-            newlinechar = line.find('\n')
-
-            if line != '':
-                comment = line.find('//')
-                if comment == -1:
-                    newlinechar = line.find('\n') 
-                    if newlinechar != -1:
-                        line = line[:newlinechar]
-                    self.infile.append(line)
-                elif comment != -1:
-                    line = line[:comment]
-                    newlinechar = line.find('\n')
-                    if newlinechar != -1:
-                        line = line[:newlinechar]
-                    if line != '':
-                        self.infile.append(line)
-
-        # remove multi-line comments from the above array
-        comment_started = False
-        comment_lines = 0
-        i = 0
-
-        while i < len(self.infile):
-            line = self.infile[i]
-            if comment_started:
-                comment_lines += 1
-            if line.startswith('/*') and (not comment_started):
-                comment_started = True
-                comment_lines += 1
-            if line.endswith('*/') and comment_started:
-                comment_started = False
-                if comment_lines == 1:
-                    del self.infile[i]
-                else:
-                    del self.infile[i-comment_lines+1:i+1]
-                i -= comment_lines
-                comment_lines = 0
-            i += 1
-
-        # looping over above array to split out symbols into separate list items. 
-        # except symbols inside strings
-        j = 0
-        while j < len(self.infile):
-            line = self.infile[j]
-            self.infile[j] = line.strip()
-
-            containsString = line.count('"') == 2
-            firstquot = line.find('"')
-            secondquot = line.find('"', firstquot + 1)
-
-            i = 0
-
-            while i < len(line):
-                if line[i] in ('{', '}', '(', ')', '[', ']', '.', ',', ';', '+', '-', '*', '/', '&', '|', '<',
-                                    '>', '=', '~'):
-                    if containsString and (i < secondquot) and (i > firstquot):
-                        i += 1
-                    else:
-                        parts = line.split(line[i], 1)
-                        del self.infile[j]
-                        self.infile.insert(j, parts[0])
-                        self.infile.insert(j+1, line[i])
-                        self.infile.insert(j+2, parts[1])
-                        j += 1
-                        break
-                else:
-                    i += 1
-                
-            j += 1
-
-        # loop over to split keywords, identifiers, etc. i.e. splitting any blank spaces except for inside strings
-        k = 0
-        while k < len(self.infile):
-            if self.infile[k].count('"') != 2:
-                parts = self.infile[k].split()
-                parts_length = len(parts)
-                if parts_length > 1:
-                    del self.infile[k]
-                    self.infile[k:k] = parts
-                    k = k + parts_length - 1
-            else: 
-                self.infile[k] = self.infile[k].strip()
-            k += 1
-
-        # loop over to remove empty strings
-        self.infile = [line.strip() for line in  self.infile if line.strip() != '']
-
+        source = infile.read()
         infile.close()
 
-        self.totaltokencount = len(self.infile)
+        line = 1
+        linestart = 0 # position in source where the current line starts
+        for match in self.token_pattern.finditer(source):
+            kind = match.lastgroup
+            value = match.group()
+            if kind == 'COMMENT' or kind == 'SPACE':
+                newlines = value.count('\n')
+                if newlines:
+                    line += newlines
+                    linestart = match.start() + value.rfind('\n') + 1
+                continue
+            column = match.start() - linestart + 1
+            if kind == 'WORD':
+                kind = 'KEYWORD' if value in self.keywords else 'IDENTIFIER'
+            elif kind == 'UNCLOSED_COMMENT' or kind == 'ERROR' or (kind == 'INT_CONST' and int(value) > 32767):
+                where = f'{self.infilename}.jack line {line}, column {column}'
+                if kind == 'INT_CONST':
+                    raise Exception(f'{where}: integer constant {value} is larger than 32767')
+                if kind == 'UNCLOSED_COMMENT':
+                    raise Exception(f'{where}: comment is never closed')
+                if value == '"':
+                    raise Exception(f'{where}: string is never closed')
+                raise Exception(f'{where}: unexpected character {value!r}')
+            self.tokens.append(Token(kind, value, line, column))
+
+        self.totaltokencount = len(self.tokens)
         self.currenttokencount = 0
         self.currenttoken = ''
+        self.currenttype = None
     
     def hasMoreTokens(self):
         # checks if there are more tokens left to be parsed
@@ -117,43 +81,30 @@ class Tokenizer:
     
     def advance(self):
         # reads the next token of the input and makes it the current token
-        self.currenttoken = self.infile[self.currenttokencount]
+        token = self.tokens[self.currenttokencount]
+        self.currenttoken = token.value
+        self.currenttype = token.type
         self.currenttokencount += 1
 
     def lookAhead(self):
         # returns the token that is after the current token
-        return self.infile[self.currenttokencount]
+        return self.tokens[self.currenttokencount].value
+
+    def position(self):
+        # returns where the current token is, for error messages
+        if self.currenttokencount == 0:
+            return f'{self.infilename}.jack'
+        token = self.tokens[self.currenttokencount - 1]
+        return f'{self.infilename}.jack line {token.line}, column {token.column}'
 
     def tokenType(self):
         # Returns the type of the current token
-        if self.currenttoken in ('class', 'constructor', 'function', 'method', 'field', 'static', 'var', 'int',
-                                 'char', 'boolean', 'void', 'true', 'false', 'null', 'this', 'let', 'do', 'if',
-                                 'else', 'while', 'return'):
-            return 'KEYWORD'
-
-        elif self.currenttoken in ('{', '}', '(', ')', '[', ']', '.', ',', ';', '+', '-', '*', '/', '&', '|', '<',
-                                    '>', '=', '~'):
-            return 'SYMBOL'
-
-        elif self.currenttoken.isdigit():
-            if int(self.currenttoken) in range (32768):
-                return 'INT_CONST'
-
-        elif self.currenttoken.startswith('"'):
-            return 'STRING_CONST'
-
-        elif not self.currenttoken[0].isdigit():
-            return 'IDENTIFIER'
-        
-        else:
-            raise Exception('Token type not found')
+        return self.currenttype
 
     def keyWord(self):
         # returns the keyword which is the current token. Only call when token type is KEYWORD
 
-        if self.currenttoken in ('class', 'constructor', 'function', 'method', 'field', 'static', 'var', 'int',
-                                 'char', 'boolean', 'void', 'true', 'false', 'null', 'this', 'let', 'do', 'if',
-                                 'else', 'while', 'return'):
+        if self.currenttype == 'KEYWORD':
             return self.currenttoken
         else:
             raise Exception('Keyword not found')
@@ -161,8 +112,7 @@ class Tokenizer:
     def symbol(self):
         # returns the character which is the current token. Only call when token type is SYMBOL
 
-        if self.currenttoken in ('{', '}', '(', ')', '[', ']', '.', ',', ';', '+', '-', '*', '/', '&', '|', '<',
-                                    '>', '=', '~'):
+        if self.currenttype == 'SYMBOL':
             return self.currenttoken
         else: 
             raise Exception('Symbol not found')
@@ -261,8 +211,12 @@ class SymbolTable:
 
 class VMWriter:
     def __init__(self, filename):
-        # Opens a new file and prepares to write
-        self.outfile = open(filename + '.vm', 'w')
+        # Opens a new file and prepares to write. with filename None the VM code is kept in memory instead, see
+        # getvalue
+        if filename is None:
+            self.outfile = io.StringIO()
+        else:
+            self.outfile = open(filename + '.vm', 'w')
         return
     
     def writePush(self, segment, index):
@@ -312,15 +266,25 @@ class VMWriter:
 
     def close(self):
         # closes the output file
-        self.outfile.close()
+        if not isinstance(self.outfile, io.StringIO):
+            self.outfile.close()
         return
 
+    def getvalue(self):
+        # returns the VM code written so far, only when writing to memory
+        return self.outfile.getvalue()
+
 
 class CompilationEngine:
-    def __init__(self, outfilename, tokenizer, symboltable, vmwriter):
-        # the next routine called must be compile class
-        self.outfile = open(outfilename + '.xml', 'w')
-        self.classname = outfilename
+    def __init__(self, outfilename, tokenizer, symboltable, vmwriter, classname=None):
+        # the next routine called must be compile class. the parse tree is written to outfilename.xml, or nowhere
+        # when outfilename is None. classname defaults to outfilename
+        self.outfile = None
+        if outfilename is not None:
+            self.outfile = open(outfilename + '.xml', 'w')
+        self.classname = classname
+        if classname is None:
+            self.classname = outfilename
 
         self.root = None
         self.currentelement = None
@@ -335,7 +299,11 @@ class CompilationEngine:
         self.tokenizer.advance()
 
         if (self.tokenizer.tokenType() == 'KEYWORD') and (self.tokenizer.keyWord() == 'class'):
-            self.compileClass()
+            try:
+                self.compileClass()
+            except Exception as error:
+                # report where in the file compiling stopped
+                raise Exception(f'{self.tokenizer.position()}: {error}') from error
         else:
             raise Exception('Expected a class declaration')
 
@@ -396,8 +364,9 @@ class CompilationEngine:
         else:
             raise Exception('Expected } for class dec')
 
-        self.outfile.write(self.prettify(self.root))
-        self.outfile.close()
+        if self.outfile is not None:
+            self.outfile.write(self.prettify(self.root))
+            self.outfile.close()
 
         self.vmwriter.close()
 
@@ -1293,31 +1262,46 @@ class CompilationEngine:
 
 ############################################################################################################
 
-infile = ''
-inname = sys.argv[1]
-cwdfiles = os.listdir('.')
-jack_program_folder = []
-
-if f'{inname}.jack' in cwdfiles:
-    infile = inname
-    tokenizer = Tokenizer(infile)
+def compileFile(infilename, classname):
+    # compiles infilename.jack (given without its extension) in memory and returns its VM code, without writing the
+    # .vm or .xml file
+    tokenizer = Tokenizer(infilename)
     symboltable = SymbolTable()
-    vmwriter = VMWriter(infile)
-    CompilationEngine(infile, tokenizer, symboltable, vmwriter)
-else:
-    jack_program_folder = os.listdir(inname)
-    jack_program_folder = [os.path.splitext(file) for file in jack_program_folder]
-    jack_program_folder = [file[0] for file in jack_program_folder if file[1] == '.jack']
-
-    os.chdir(inname)
-
-    while len(jack_program_folder) != 0:
-        infile = jack_program_folder[0]
-        jack_program_folder.pop(0)
+    vmwriter = VMWriter(None)
+    CompilationEngine(None, tokenizer, symboltable, vmwriter, classname)
+    return vmwriter.getvalue()
+
+def main():
+    # python JackCompiler.py Prog compiles Prog.jack or every .jack file in the directory Prog into .vm and .xml
+    # files next to them
+    infile = ''
+    inname = sys.argv[1]
+    cwdfiles = os.listdir('.')
+    jack_program_folder = []
+
+    if f'{inname}.jack' in cwdfiles:
+        infile = inname
         tokenizer = Tokenizer(infile)
         symboltable = SymbolTable()
         vmwriter = VMWriter(infile)
         CompilationEngine(infile, tokenizer, symboltable, vmwriter)
+    else:
+        jack_program_folder = os.listdir(inname)
+        jack_program_folder = [os.path.splitext(file) for file in jack_program_folder]
+        jack_program_folder = [file[0] for file in jack_program_folder if file[1] == '.jack']
+
+        os.chdir(inname)
+
+        while len(jack_program_folder) != 0:
+            infile = jack_program_folder[0]
+            jack_program_folder.pop(0)
+            tokenizer = Tokenizer(infile)
+            symboltable = SymbolTable()
+            vmwriter = VMWriter(infile)
+            CompilationEngine(infile, tokenizer, symboltable, vmwriter)
+
+if __name__ == '__main__':
+    main()
         
 
 
@@ -1,108 +1,424 @@
 import os, sys
+from concurrent.futures import ProcessPoolExecutor
+
+class Command:
+    # one VM command split into its parts. every line is split up exactly once, when it is read, and everything
+    # after that (the translator, the whole-program passes, the VM interpreter) only reads these fields
+    __slots__ = ('type', 'arg1', 'arg2')
+
+    def __init__(self, type, arg1, arg2=None):
+        self.type = type
+        self.arg1 = arg1 # the command itself for C_ARITHMETIC, None for C_RETURN
+        self.arg2 = arg2 # an int for C_PUSH, C_POP, C_FUNCTION and C_CALL, otherwise None
+
+command_types = {'add': 'C_ARITHMETIC', 'sub': 'C_ARITHMETIC', 'neg': 'C_ARITHMETIC', 'eq': 'C_ARITHMETIC',
+                 'gt': 'C_ARITHMETIC', 'lt': 'C_ARITHMETIC', 'and': 'C_ARITHMETIC', 'or': 'C_ARITHMETIC',
+                 'not': 'C_ARITHMETIC', 'push': 'C_PUSH', 'pop': 'C_POP', 'label': 'C_LABEL', 'goto': 'C_GOTO',
+                 'if-goto': 'C_IF', 'function': 'C_FUNCTION', 'call': 'C_CALL', 'return': 'C_RETURN'}
+
+# number of arguments every command type takes
+argument_counts = {'C_ARITHMETIC': 0, 'C_RETURN': 0, 'C_LABEL': 1, 'C_GOTO': 1, 'C_IF': 1, 'C_PUSH': 2, 'C_POP': 2,
+                   'C_FUNCTION': 2, 'C_CALL': 2}
+
+def parseCommand(line):
+    # splits a VM command without comments or surrounding white space into a Command
+    parts = line.split()
+    if parts[0] not in command_types:
+        raise Exception(f'Command type not known: {line}')
+    command_type = command_types[parts[0]]
+    if len(parts) - 1 != argument_counts[command_type]:
+        raise Exception(f'Wrong number of arguments, {parts[0]} takes {argument_counts[command_type]}: {line}')
+    if command_type == 'C_ARITHMETIC':
+        return Command(command_type, parts[0])
+    if command_type == 'C_RETURN':
+        return Command(command_type, None)
+    if len(parts) > 2:
+        if not parts[2].isdigit():
+            raise Exception(f'{parts[0]} takes a non-negative number as its second argument: {line}')
+        return Command(command_type, parts[1], int(parts[2]))
+    return Command(command_type, parts[1])
+
+max_parsed_lines = 65536 # most distinct lines parseLines keeps the Command of at a time
+
+def parseLines(lines):
+    # cleans up comments and empty lines and yields the remaining VM commands one at a time as Commands, so that a
+    # file can be translated while it is being read. identical lines share one Command
+    parsed = {}
+    for line in lines:
+        comment = line.find('//')
+        if comment != -1:
+            line = line[:comment]
+        line = line.strip()
+        if line == '':
+            continue
+        command = parsed.get(line)
+        if command is None:
+            if len(parsed) == max_parsed_lines:
+                parsed.clear()
+            command = parseCommand(line)
+            parsed[line] = command
+        yield command
+
+def readCommands(infilename):
+    # yields the commands of infilename.vm one at a time, reading the file line by line
+    infile = open(infilename + '.vm')
+    yield from parseLines(infile)
+    infile.close()
 
 class Parser: 
     #parsers a single .vm input file 
-    def __init__(self, infilename):
-        # opens input file and gets ready to parse it
+    def __init__(self, infilename, lines=None):
+        # opens input file and gets ready to parse it. if lines (the VM code as a list of lines, e.g. straight from
+        # the Jack compiler) is given they are parsed instead and infilename is only used as the file's name.
+        # the whole file is parsed into a list of Commands right away, for the passes that need to see all of a
+        # program before translating it. translating a file on its own doesn't need a Parser, see translateFiles
         self.infilename = infilename
-        self.infile = []
-
-        # cleaning up any comments and empty lines in the input file and storing each line in an array
-        infile = open(self.infilename + '.vm')
-        for line in infile:
-
-            line = line.strip()
-            comment = line.find('//')
-            newlinechar = line.find('\n')
-
-            if line != '':
-                comment = line.find('//')
-                if comment == -1:
-                    newlinechar = line.find('\n') 
-                    if newlinechar != -1:
-                        line = line[:newlinechar]
-                    self.infile.append(line)
-                elif comment != -1:
-                    line = line[:comment]
-                    newlinechar = line.find('\n')
-                    if newlinechar != -1:
-                        line = line[:newlinechar]
-                    if line != '':
-                        self.infile.append(line)
-        infile.close()
-
-        self.totalcommandcount = len(self.infile)
+        if lines is None:
+            self.commands = list(readCommands(infilename))
+        else:
+            self.commands = list(parseLines(lines))
+
         self.currentcommandcount = 0
-        self.currentcommand = ''
+        self.currentcommand = None
     
     def hasMoreCommands(self):
         # checks if there are more commands left to be parsed
-        if(self.currentcommandcount < self.totalcommandcount):
-            return True
-        return False
+        return self.currentcommandcount < len(self.commands)
     
     def advance(self):
         # reads the next command of the input and makes it the current command
-        self.currentcommand = self.infile[self.currentcommandcount]
+        self.currentcommand = self.commands[self.currentcommandcount]
         self.currentcommandcount += 1
     
     def commandType(self):
         # returns the type of the current command
         if self.currentcommandcount == 0:
             raise Exception('Please advance the parser to the first command before calling this method')
-
-        arithmetic_strings = ['add', 'sub', 'neg', 'eq', 'gt', 'lt', 'and', 'or', 'not']
-
-        currentCommand = self.currentcommand.split()[0]
-
-        if any(currentCommand == string for string in arithmetic_strings):
-            return 'C_ARITHMETIC'
-    
-        elif 'push' == currentCommand:
-            return 'C_PUSH'
-        elif 'pop' == currentCommand:
-            return 'C_POP'
-
-        elif 'label' == currentCommand:
-            return 'C_LABEL'
-        elif 'if-goto' == currentCommand:
-            return 'C_IF'
-        elif 'goto' == currentCommand:
-            return 'C_GOTO'
-
-        elif 'function' == currentCommand:
-            return 'C_FUNCTION'
-        elif 'return' == currentCommand:
-            return 'C_RETURN'
-        elif 'call' == currentCommand:
-            return 'C_CALL'
-
-        raise Exception('Command type not known.')
+        return self.currentcommand.type
     
     def arg1(self):
         # Returns the first argument of the current command.
         # In the case of C_ARITHMETIC, the command itself is returned.
         # Should not be called if the current command in C_RETURN
-        split_command = self.currentcommand.split()
-
-        arg1 = split_command[0]
-
-        if len(split_command) > 1:
-            arg1 = split_command[1]
-        
-        return arg1
+        return self.currentcommand.arg1
 
     def arg2(self):
         # Returns the second argument of the current command
         # Should only be called if command is one of the following types:
         # C_PUSH, C_POP, C_FUNCTION, C_CALL
-        return int(self.currentcommand.split()[2])
+        return self.currentcommand.arg2
+
+class Inliner:
+    # replaces calls to small functions with the body of the function, working on the commands of the parsed files
+    # of a whole program before anything is translated.
+    # a function is inlined if it calls nothing (so it can't be recursive either), has at most max_size commands and
+    # leaves exactly its return value on the stack at every return. its arguments and locals are moved to temp
+    # entries that neither the function nor the caller uses: temp may change across any call, so the caller can't
+    # depend on the entries the function would have left alone. the pointer entries the function pops are saved in
+    # temp as well and restored after the body, as the return would restore THIS and THAT
+    max_size = 12
+
+    def __init__(self):
+        self.inlined = 0 # number of calls replaced
+
+    def functions(self, parsers, filenames):
+        # returns the functions of the program: name -> (file name, number of locals, body). the body is the list of
+        # the function's commands, without the function command
+        functions = {}
+        for parser, filename in zip(parsers, filenames):
+            body = None
+            for command in parser.commands:
+                if command.type == 'C_FUNCTION':
+                    body = []
+                    functions[command.arg1] = (filename, command.arg2, body)
+                elif body is not None:
+                    body.append(command)
+        return functions
+
+    def inlineable(self, body):
+        # checks that a function body is small, calls nothing and ends in a return with the stack balanced
+        if len(body) > self.max_size + 1 or len(body) == 0 or body[-1].type != 'C_RETURN':
+            return False
+        if any(command.type in ('C_CALL', 'C_FUNCTION') for command in body):
+            return False
+        return self.balanced(body)
+
+    def balanced(self, body):
+        # follows the stack depth through a function body: it may never take away or read more than the body pushed,
+        # has to be the same whichever way a label is reached and has to be exactly 1 (the return value) at every
+        # return. inlined, anything below the body's own pushes belongs to the caller
+        depth = 0
+        labels = {} # label -> stack depth there
+        for command in body:
+            if depth is None:
+                # after a goto or return only a label reached from somewhere else can follow
+                if command.type != 'C_LABEL' or command.arg1 not in labels:
+                    return False
+                depth = labels[command.arg1]
+            if command.type == 'C_LABEL':
+                if labels.setdefault(command.arg1, depth) != depth:
+                    return False
+            elif command.type in ('C_GOTO', 'C_IF'):
+                if command.type == 'C_IF':
+                    depth -= 1
+                if labels.setdefault(command.arg1, depth) != depth:
+                    return False
+                if command.type == 'C_GOTO':
+                    depth = None
+            elif command.type == 'C_RETURN':
+                if depth != 1:
+                    return False
+                depth = None
+            elif command.type == 'C_PUSH':
+                depth += 1
+            elif command.type == 'C_POP':
+                depth -= 1
+            elif command.arg1 in ('neg', 'not'):
+                if depth < 1:
+                    return False
+            else:
+                if depth < 2:
+                    return False
+                depth -= 1
+            if depth is not None and depth < 0:
+                return False
+        return True
+
+    def indexes(self, body, segment, types=('C_PUSH', 'C_POP')):
+        # the indexes of a segment the pushes and pops in a list of commands use
+        return {command.arg2 for command in body if command.type in types and command.arg1 == segment}
+
+    def expand(self, body, numLocals, numArgs, free):
+        # returns the commands that replace a call to a function with the given body, or None if it can't be inlined
+        # at this call. free is the list of temp entries it may use
+        saved = sorted(self.indexes(body, 'pointer', ('C_POP',)))
+        if any(index >= numArgs for index in self.indexes(body, 'argument')):
+            return None
+        if any(index >= numLocals for index in self.indexes(body, 'local')):
+            return None
+        if numArgs + numLocals + len(saved) > len(free):
+            return None
+
+        argument_slots = free[:numArgs]
+        local_slots = free[numArgs:numArgs + numLocals]
+        save_slots = free[numArgs + numLocals:numArgs + numLocals + len(saved)]
+        suffix = f'$inline{self.inlined}'
+        end_label = 'END' + suffix
+
+        # the arguments are on the stack, the last one on top
+        commands = [Command('C_POP', 'temp', slot) for slot in reversed(argument_slots)]
+        for slot in local_slots:
+            commands += [Command('C_PUSH', 'constant', 0), Command('C_POP', 'temp', slot)]
+        for pointer, slot in zip(saved, save_slots):
+            commands += [Command('C_PUSH', 'pointer', pointer), Command('C_POP', 'temp', slot)]
+
+        jumps_to_end = False
+        for i, command in enumerate(body):
+            if command.type in ('C_PUSH', 'C_POP') and command.arg1 == 'argument':
+                commands.append(Command(command.type, 'temp', argument_slots[command.arg2]))
+            elif command.type in ('C_PUSH', 'C_POP') and command.arg1 == 'local':
+                commands.append(Command(command.type, 'temp', local_slots[command.arg2]))
+            elif command.type in ('C_LABEL', 'C_GOTO', 'C_IF'):
+                commands.append(Command(command.type, command.arg1 + suffix))
+            elif command.type == 'C_RETURN':
+                if i != len(body) - 1:
+                    commands.append(Command('C_GOTO', end_label))
+                    jumps_to_end = True
+            else:
+                commands.append(command)
+        if jumps_to_end:
+            commands.append(Command('C_LABEL', end_label))
+
+        # the return value stays on top of the stack while the pointers are restored
+        for pointer, slot in zip(saved, save_slots):
+            commands += [Command('C_PUSH', 'temp', slot), Command('C_POP', 'pointer', pointer)]
+        return commands
+
+    def inline(self, parsers, filenames):
+        # inlines every call to an inlineable function in the parsed files
+        functions = self.functions(parsers, filenames)
+        candidates = {name: function for name, function in functions.items() if self.inlineable(function[2])}
+
+        for parser, filename in zip(parsers, filenames):
+            # the commands of the file grouped by function, with anything before the first function on its own
+            groups = [[]]
+            for command in parser.commands:
+                if command.type == 'C_FUNCTION':
+                    groups.append([])
+                groups[-1].append(command)
+
+            commands = []
+            for group in groups:
+                caller_temps = self.indexes(group, 'temp')
+                for command in group:
+                    expansion = None
+                    if command.type == 'C_CALL' and command.arg1 in candidates:
+                        callee_file, numLocals, body = candidates[command.arg1]
+                        # the statics of another file can't be reached from this one
+                        if callee_file == filename or len(self.indexes(body, 'static')) == 0:
+                            free = [i for i in range(8) if i not in caller_temps | self.indexes(body, 'temp')]
+                            expansion = self.expand(body, numLocals, command.arg2, free)
+                    if expansion is None:
+                        commands.append(command)
+                    else:
+                        commands += expansion
+                        self.inlined += 1
+            parser.commands = commands
+
+class PeepholeOptimizer:
+    # rewrites the Hack assembly emitted by CodeWriter into shorter sequences that do the same thing.
+    # it works on a list of assembly lines and only ever matches straight-line sequences of instructions: a label
+    # line never matches any pattern, so nothing is moved across a jump target
+    segment_symbols = ('@LCL', '@ARG', '@THIS', '@THAT')
+    fixed_bases = {'@5': 5, '@3': 3} # temp and pointer
+
+    # the longest a constant offset into local/argument/this/that can be before stepping to it with A=A+1 costs
+    # more than computing the address through R13
+    max_stepped_offset = 5
+
+    def __init__(self):
+        self.before = 0
+        self.after = 0
+
+    def optimize(self, lines):
+        # returns the optimized version of a list of assembly lines
+        lines = [line for line in lines if line != '']
+        self.before += self.countInstructions(lines)
+        changed = True
+        while changed:
+            optimized = self.removeRedundantLoads(self.fusePushPop(self.foldSegmentAccess(lines)))
+            changed = optimized != lines
+            lines = optimized
+        self.after += self.countInstructions(lines)
+        return lines
+
+    def countInstructions(self, lines):
+        # number of instructions in a list of assembly lines, labels don't take up ROM
+        return sum(1 for line in lines if not line.startswith('('))
+
+    def constant(self, line):
+        # returns the number loaded by an @number line, otherwise None
+        if line.startswith('@') and line[1:].isdigit():
+            return int(line[1:])
+        return None
+
+    def foldSegmentAccess(self, lines):
+        # pushes and pops with a constant index compute the address with D=A, A=D+A or go through R13.
+        # the address of temp and pointer entries is known here, and the address of small local/argument/this/that
+        # offsets can be reached with A=M+1 / A=A+1 steps
+        out = []
+        i = 0
+        while i < len(lines):
+            index = self.constant(lines[i])
+            window = lines[i + 1:i + 13]
+            if index is not None and window[:1] == ['D=A'] and len(window) >= 4:
+                base = window[1]
+
+                # push temp/pointer i: @i D=A @5 A=D+A D=M
+                if base in self.fixed_bases and window[2:4] == ['A=D+A', 'D=M']:
+                    out += [f'@{self.fixed_bases[base] + index}', 'D=M']
+                    i += 5
+                    continue
+
+                # push segment i: @i D=A @SEG A=M A=D+A D=M
+                if base in self.segment_symbols and window[2:5] == ['A=M', 'A=D+A', 'D=M']:
+                    if index == 0:
+                        out += [base, 'A=M', 'D=M']
+                    elif index == 1:
+                        out += [base, 'A=M+1', 'D=M']
+                    else:
+                        out += [f'@{index}', 'D=A', base, 'A=D+M', 'D=M']
+                    i += 6
+                    continue
+
+                popping = window[3:11] == ['@13', 'M=D', '@SP', 'AM=M-1', 'D=M', '@13', 'A=M', 'M=D']
+
+                # pop temp/pointer i: @i D=A @5 D=D+A @13 M=D @SP AM=M-1 D=M @13 A=M M=D
+                if base in self.fixed_bases and window[2] == 'D=D+A' and popping:
+                    out += ['@SP', 'AM=M-1', 'D=M', f'@{self.fixed_bases[base] + index}', 'M=D']
+                    i += 12
+                    continue
+
+                # pop segment i: @i D=A @SEG D=D+M @13 M=D @SP AM=M-1 D=M @13 A=M M=D
+                if (base in self.segment_symbols and window[2] == 'D=D+M' and popping
+                        and index <= self.max_stepped_offset):
+                    steps = ['A=M+1'] + ['A=A+1'] * (index - 1) if index > 0 else ['A=M']
+                    out += ['@SP', 'AM=M-1', 'D=M', base] + steps + ['M=D']
+                    i += 12
+                    continue
+
+            out.append(lines[i])
+            i += 1
+        return out
+
+    def fusePushPop(self, lines):
+        # a push of D immediately followed by a pop into D: @SP A=M M=D @SP M=M+1 @SP AM=M-1 D=M
+        # leaves the stack as it was with the value still in D and A = SP, so only A needs setting
+        pushpop = ['@SP', 'A=M', 'M=D', '@SP', 'M=M+1', '@SP', 'AM=M-1', 'D=M']
+        out = []
+        i = 0
+        while i < len(lines):
+            if lines[i] == '@SP' and lines[i:i + 8] == pushpop:
+                out += ['@SP', 'A=M']
+                i += 8
+                continue
+            out.append(lines[i])
+            i += 1
+        return out
+
+    def removeRedundantLoads(self, lines):
+        # drops @X when A already holds X, and @SP A=M when the next instruction loads A again anyway
+        out = []
+        knowna = None # the @ line A currently holds, if known
+        for i, line in enumerate(lines):
+            if line.startswith('('):
+                knowna = None
+            elif line.startswith('@'):
+                if line == knowna:
+                    continue
+                knowna = line
+            else:
+                if line == 'A=M' and out[-1:] == ['@SP'] and lines[i + 1:i + 2] and lines[i + 1].startswith('@'):
+                    out.pop()
+                    knowna = None
+                    continue
+                equals = line.find('=')
+                if equals != -1 and 'A' in line[:equals]:
+                    knowna = None
+            out.append(line)
+        return out
 
 class CodeWriter:
-    def __init__(self, outfilename):
+    def __init__(self, outfilename, optimize=False, trampolines=False, shared_compare=False):
+        # with optimize set the emitted assembly is run through the PeepholeOptimizer before it is written out.
+        # with trampolines set every call and return jumps to one shared call routine and one shared return routine
+        # instead of inlining the frame handling, see writeCall and writeReturn.
+        # with shared_compare set eq, gt and lt jump to one shared routine each, see writeCompare. with the optimizer
+        # on as well, only where that is shorter than the optimized inline comparison, see followsPush.
+        # the assembly is collected as a list of fragments and written out in large chunks. with outfilename None
+        # nothing is written to disk and getvalue() returns the assembly after close().
+        # the labels the CodeWriter makes up for comparisons and return addresses are numbered per file and start
+        # with the file name, so that every file can be translated on its own, see translateFile
         self.filename = ''
-        self.outfile = open(outfilename + '.asm', 'w')
-
+        self.trampolines = trampolines
+        self.shared_compare = shared_compare
+        self.used_routines = [] # shared routines that have to be written out on close(), in order of first use
+        self.asmfile = None
+        if outfilename is not None:
+            self.asmfile = open(outfilename + '.asm', 'w')
+        self.fragments = [] # assembly written since the last flush()
+        self.chunks = []    # flushed assembly kept in memory, when there is no file to write it to yet
+        # write() adds a piece of assembly to the output. it is the list's own append so that writing costs no more
+        # than a call to file.write() did, the fragments are flushed at labels and between commands, see flushIfFull
+        # and translateCommands
+        self.write = self.fragments.append
+        self.optimizer = None
+        self.command_flush_fragments = self.flush_fragments
+        if optimize:
+            self.optimizer = PeepholeOptimizer()
+            self.command_flush_fragments = self.max_fragments
+
+        self.label_namespace = ''
         self.logic_label_number = 0
         self.logic_available_label = f"VMLABEL{self.logic_label_number}"
 
@@ -111,11 +427,59 @@ class CodeWriter:
         self.static_prefix = self.filename
         self.static_index = 0
 
+    flush_fragments = 4096 # number of fragments collected before they are joined into one chunk
+    # with the optimizer, the number of fragments after which a chunk is cut between two commands even though there
+    # is no label. a pattern that would have matched across the cut is missed, which costs a few instructions per cut
+    max_fragments = 65536
+
+    def flushIfFull(self):
+        # only called right before or right after a label is written. no peephole pattern matches across a label, so
+        # optimizing the chunks one by one gives the same result as optimizing the whole program at once
+        if len(self.fragments) >= self.flush_fragments:
+            self.flush()
+
+    def flush(self):
+        # joins the collected fragments into one chunk, optimizes it and writes it out
+        if len(self.fragments) == 0:
+            return
+        chunk = ''.join(self.fragments)
+        self.fragments.clear()
+        if self.optimizer is not None:
+            chunk = '\n'.join(self.optimizer.optimize(chunk.split('\n'))) + '\n'
+        self.writeChunk(chunk)
+
+    def writeChunk(self, chunk):
+        # writes finished assembly to the .asm file, or keeps it in memory when there is none
+        if self.asmfile is None:
+            self.chunks.append(chunk)
+        else:
+            self.asmfile.write(chunk)
+
+    def writeTranslated(self, assembly, routines):
+        # adds the finished assembly of a file translated by another CodeWriter, and the shared routines it uses
+        self.flush()
+        self.writeChunk(assembly)
+        for name in routines:
+            self.useRoutine(name)
+
+    def getvalue(self):
+        # returns the assembly kept in memory, the whole program after close() when there is no output file
+        self.flush()
+        return ''.join(self.chunks)
+
+    def writeInit(self):
+        # the bootstrap code: sets SP to 256 and calls Sys.init
+        self.write('@256\nD=A\n@SP\nM=D\n')
+        self.writeCall('Sys.init', 0)
+
     def setFileName(self, filename):
         # informs the CodeWriter that the current file being parsed has been changed
         self.filename = filename
         self.static_prefix = self.filename
         self.static_index = 0
+        self.label_namespace = filename + '$'
+        self.logic_label_number = 0
+        self.logic_available_label = f"{self.label_namespace}VMLABEL{self.logic_label_number}"
 
     def writeArithmetic(self, command):
         # arg1 in variable names refers to the top value in the stack
@@ -136,69 +500,95 @@ class CodeWriter:
         def nextAvailableLabel(self):
         # changes the available label to a value that has not been used previously
             self.logic_label_number += 1
-            self.logic_available_label = f"VMLABEL{self.logic_label_number}"
+            self.logic_available_label = f"{self.label_namespace}VMLABEL{self.logic_label_number}"
             return
 
-        if command == 'neg':
-            self.outfile.write(set_a_to_arg1_address + 'M=-M\n')
+        if self.shared_compare and command in self.compare_routines and not self.followsPush():
+            self.writeCompare(command)
+            nextAvailableLabel(self)
+        elif command == 'neg':
+            self.write(set_a_to_arg1_address + 'M=-M\n')
         elif command == 'not':
-            self.outfile.write(set_a_to_arg1_address + 'M=!M\n')
+            self.write(set_a_to_arg1_address + 'M=!M\n')
         elif command == 'add':
-            self.outfile.write(set_d_to_arg1_and_decrement_SP + set_a_to_arg2_address + 'M=D+M\n')
+            self.write(set_d_to_arg1_and_decrement_SP + set_a_to_arg2_address + 'M=D+M\n')
         elif command == 'sub':
-            self.outfile.write(set_d_to_arg1_and_decrement_SP + set_a_to_arg2_address + 'M=M-D\n')
+            self.write(set_d_to_arg1_and_decrement_SP + set_a_to_arg2_address + 'M=M-D\n')
         elif command == 'or':
-            self.outfile.write(set_d_to_arg1_and_decrement_SP + set_a_to_arg2_address + 'M=D|M\n')
+            self.write(set_d_to_arg1_and_decrement_SP + set_a_to_arg2_address + 'M=D|M\n')
         elif command == 'and':
-            self.outfile.write(set_d_to_arg1_and_decrement_SP + set_a_to_arg2_address + 'M=D&M\n')
+            self.write(set_d_to_arg1_and_decrement_SP + set_a_to_arg2_address + 'M=D&M\n')
         elif command == 'eq':
-            self.outfile.write(set_d_to_arg1_and_decrement_SP + set_a_to_arg2_address + set_d_to_arg2_minus_arg1 
+            self.write(set_d_to_arg1_and_decrement_SP + set_a_to_arg2_address + set_d_to_arg2_minus_arg1 
                                + set_m_to_true + set_a_to_end_label + 'D;JEQ\n' + '@SP\n' 
                                + 'A=M-1\n' + set_m_to_false + end_label)
             nextAvailableLabel(self)
         elif command == 'gt':
-            self.outfile.write(set_d_to_arg1_and_decrement_SP + set_a_to_arg2_address + set_d_to_arg2_minus_arg1 
+            self.write(set_d_to_arg1_and_decrement_SP + set_a_to_arg2_address + set_d_to_arg2_minus_arg1 
                                + set_m_to_true + set_a_to_end_label + 'D;JGT\n' + '@SP\n' 
                                + 'A=M-1\n' + set_m_to_false + end_label)
             nextAvailableLabel(self)
         elif command == 'lt':
-            self.outfile.write(set_d_to_arg1_and_decrement_SP + set_a_to_arg2_address + set_d_to_arg2_minus_arg1 
+            self.write(set_d_to_arg1_and_decrement_SP + set_a_to_arg2_address + set_d_to_arg2_minus_arg1 
                                + set_m_to_true + set_a_to_end_label + 'D;JLT\n' + '@SP\n' 
                                + 'A=M-1\n' + set_m_to_false + end_label)
             nextAvailableLabel(self)
         else:
             raise Exception("Arithmetic Command Not Found")
 
+    compare_routines = {'eq': 'VM$EQ', 'gt': 'VM$GT', 'lt': 'VM$LT'}
+
+    def followsPush(self):
+        # checks if the optimizer is on and the assembly written last pushes D. the optimizer fuses that push with the
+        # pop an inline comparison starts with, which leaves 5 instructions, one less than jumping to a shared routine
+        return (self.optimizer is not None and len(self.fragments) != 0
+                and self.fragments[-1].endswith('@SP\nA=M\nM=D\n@SP\nM=M+1\n'))
+
+    def writeCompare(self, command):
+        # jumps to the shared routine for eq, gt or lt with the return address in R13. the call still needs a label
+        # to return to, but it takes 6 instructions instead of the 11 of the inline comparison
+        return_label = self.logic_available_label
+        routine = self.compare_routines[command]
+        self.useRoutine(routine)
+        self.write(f'@{return_label}\nD=A\n@R13\nM=D\n@{routine}\n0;JMP\n({return_label})\n')
+
+    def writeCompareRoutine(self, routine):
+        # the shared routine for one comparison: replaces the top two values of the stack with true or false and
+        # jumps back to the address in R13
+        jump = {'VM$EQ': 'JEQ', 'VM$GT': 'JGT', 'VM$LT': 'JLT'}[routine]
+        self.write(f'({routine})\n' + '@SP\nAM=M-1\nD=M\nA=A-1\nD=M-D\nM=-1\n' + f'@{routine}$END\nD;{jump}\n'
+                           + '@SP\nA=M-1\nM=0\n' + f'({routine}$END)\n' + '@R13\nA=M\n0;JMP\n')
+
     def writePushPop(self, command, segment, index):
 
         push_d_to_stack_and_increment_SP = '@SP\nA=M\nM=D\n@SP\nM=M+1\n'
         pop_stack_to_d_and_decrement_SP = '@SP\nAM=M-1\nD=M\n'
         if command == 'C_PUSH':
             if segment == 'constant':
-                self.outfile.write('@' + str(index) + '\nD=A\n' + push_d_to_stack_and_increment_SP)
+                self.write('@' + str(index) + '\nD=A\n' + push_d_to_stack_and_increment_SP)
             elif segment == 'temp':
-                self.outfile.write('@' + str(index) + '\nD=A\n@5\nA=D+A\nD=M\n' + 
+                self.write('@' + str(index) + '\nD=A\n@5\nA=D+A\nD=M\n' + 
                                     push_d_to_stack_and_increment_SP)
             elif segment == 'argument':
-                self.outfile.write('@' + str(index) + '\nD=A\n@ARG\nA=M\nA=D+A\nD=M\n' + 
+                self.write('@' + str(index) + '\nD=A\n@ARG\nA=M\nA=D+A\nD=M\n' + 
                                     push_d_to_stack_and_increment_SP)
             elif segment == 'local':
-                self.outfile.write('@' + str(index) + '\nD=A\n@LCL\nA=M\nA=D+A\nD=M\n' + 
+                self.write('@' + str(index) + '\nD=A\n@LCL\nA=M\nA=D+A\nD=M\n' + 
                                     push_d_to_stack_and_increment_SP)
             elif segment == 'this':
-                self.outfile.write('@' + str(index) + '\nD=A\n@THIS\nA=M\nA=D+A\nD=M\n' + 
+                self.write('@' + str(index) + '\nD=A\n@THIS\nA=M\nA=D+A\nD=M\n' + 
                                     push_d_to_stack_and_increment_SP)
             elif segment == 'that':
-                self.outfile.write('@' + str(index) + '\nD=A\n@THAT\nA=M\nA=D+A\nD=M\n' + 
+                self.write('@' + str(index) + '\nD=A\n@THAT\nA=M\nA=D+A\nD=M\n' + 
                                     push_d_to_stack_and_increment_SP)
             elif segment == 'pointer':
-                self.outfile.write('@' + str(index) + '\nD=A\n@3\nA=D+A\nD=M\n' + 
+                self.write('@' + str(index) + '\nD=A\n@3\nA=D+A\nD=M\n' + 
                                     push_d_to_stack_and_increment_SP)
             # elif segment == 'static':
-            #     self.outfile.write('@' + str(index) + '\nD=A\n@16\nA=D+A\nD=M\n' + 
+            #     self.write('@' + str(index) + '\nD=A\n@16\nA=D+A\nD=M\n' + 
             #                         push_d_to_stack_and_increment_SP)
             elif segment == 'static':
-                self.outfile.write(f"@{self.static_prefix}.{index}\n" + 'D=M\n' + 
+                self.write(f"@{self.static_prefix}.{index}\n" + 'D=M\n' + 
                                     push_d_to_stack_and_increment_SP)
                 self.static_index += 1
             else:
@@ -206,28 +596,28 @@ class CodeWriter:
             
         elif command == 'C_POP':
             if segment == 'temp':
-                self.outfile.write('@' + str(index) + '\nD=A\n@5\nD=D+A\n@13\nM=D\n' + 
+                self.write('@' + str(index) + '\nD=A\n@5\nD=D+A\n@13\nM=D\n' + 
                                     pop_stack_to_d_and_decrement_SP + '\n@13\nA=M\nM=D\n')
             elif segment == 'argument':
-                self.outfile.write('@' + str(index) + '\nD=A\n@ARG\n\nD=D+M\n@13\nM=D\n' + 
+                self.write('@' + str(index) + '\nD=A\n@ARG\n\nD=D+M\n@13\nM=D\n' + 
                                     pop_stack_to_d_and_decrement_SP + '\n@13\nA=M\nM=D\n')
             elif segment == 'local':
-                self.outfile.write('@' + str(index) + '\nD=A\n@LCL\n\nD=D+M\n@13\nM=D\n' + 
+                self.write('@' + str(index) + '\nD=A\n@LCL\n\nD=D+M\n@13\nM=D\n' + 
                                     pop_stack_to_d_and_decrement_SP + '\n@13\nA=M\nM=D\n')
             elif segment == 'this':
-                self.outfile.write('@' + str(index) + '\nD=A\n@THIS\n\nD=D+M\n@13\nM=D\n' + 
+                self.write('@' + str(index) + '\nD=A\n@THIS\n\nD=D+M\n@13\nM=D\n' + 
                                     pop_stack_to_d_and_decrement_SP + '\n@13\nA=M\nM=D\n')
             elif segment == 'that':
-                self.outfile.write('@' + str(index) + '\nD=A\n@THAT\n\nD=D+M\n@13\nM=D\n' + 
+                self.write('@' + str(index) + '\nD=A\n@THAT\n\nD=D+M\n@13\nM=D\n' + 
                                     pop_stack_to_d_and_decrement_SP + '\n@13\nA=M\nM=D\n')
             elif segment == 'pointer':
-                self.outfile.write('@' + str(index) + '\nD=A\n@3\nD=D+A\n@13\nM=D\n' + 
+                self.write('@' + str(index) + '\nD=A\n@3\nD=D+A\n@13\nM=D\n' + 
                                     pop_stack_to_d_and_decrement_SP + '\n@13\nA=M\nM=D\n')
             # elif segment == 'static':
-            #     self.outfile.write('@' + str(index) + '\nD=A\n@16\nD=D+A\n@13\nM=D\n' + 
+            #     self.write('@' + str(index) + '\nD=A\n@16\nD=D+A\n@13\nM=D\n' + 
             #                         pop_stack_to_d_and_decrement_SP + '\n@13\nA=M\nM=D\n')
             elif segment == 'static':
-                self.outfile.write(pop_stack_to_d_and_decrement_SP + 
+                self.write(pop_stack_to_d_and_decrement_SP + 
                                     f"@{self.static_prefix}.{index}\n" + 'M=D\n')
                 self.static_index += 1
             else:
@@ -236,17 +626,19 @@ class CodeWriter:
             raise Exception('Push Pop Command Not Found')
     
     def writeLabel(self, label):
-        self.outfile.write('(' + self.label_prefix + label + ')\n')
+        self.flushIfFull()
+        self.write('(' + self.label_prefix + label + ')\n')
 
     def writeGoto(self, label):
-        self.outfile.write('@' + self.label_prefix + label + '\n0;JMP\n')
+        self.write('@' + self.label_prefix + label + '\n0;JMP\n')
 
     def writeIf(self, label):
-        self.outfile.write('@SP\nAM=M-1\nD=M\n@' + self.label_prefix + label + '\nD;JNE\n')
+        self.write('@SP\nAM=M-1\nD=M\n@' + self.label_prefix + label + '\nD;JNE\n')
 
     def writeFunction(self, functionName, numLocals):
+        self.flushIfFull()
         self.label_prefix = functionName + '$'
-        self.outfile.write('(' + functionName + ')\n')
+        self.write('(' + functionName + ')\n')
         for i in range(numLocals):
             self.writePushPop('C_PUSH', 'constant', 0)
 
@@ -255,161 +647,427 @@ class CodeWriter:
         def nextAvailableLabel(self):
             # changes the available label to a value that has not been used previously
             self.logic_label_number += 1
-            self.logic_available_label = f"VMLABEL{self.logic_label_number}"
+            self.logic_available_label = f"{self.label_namespace}VMLABEL{self.logic_label_number}"
             return
     
         return_label = self.logic_available_label
         nextAvailableLabel(self)
 
-        # push return address 
-        self.outfile.write(f'@{return_label}\n' + 'D=A\n' + '@SP\nA=M\nM=D\n@SP\nM=M+1\n')
+        if self.trampolines:
+            # R13 = address of the called function, R14 = numArgs, D = return address, then the shared call routine
+            # pushes the frame and jumps to the function
+            self.useRoutine('VM$CALL')
+            self.write(f'@{functionName}\nD=A\n@R13\nM=D\n')
+            if numArgs in (0, 1):
+                self.write(f'@R14\nM={numArgs}\n')
+            else:
+                self.write(f'@{numArgs}\nD=A\n@R14\nM=D\n')
+            self.write(f'@{return_label}\nD=A\n@VM$CALL\n0;JMP\n({return_label})\n')
+            self.flushIfFull()
+            return
 
-        # push LCL
-        self.outfile.write('@LCL\nD=M\n' + '@SP\nA=M\nM=D\n@SP\nM=M+1\n')
+        # push return address, then LCL, ARG, THIS and THAT
+        self.write(f'@{return_label}\n' + 'D=A\n' + '@SP\nA=M\nM=D\n@SP\nM=M+1\n' + self.push_frame_pointers
+                   # set ARG to SP-numArgs-5
+                   + f'@{numArgs}\nD=A\n@5\nD=D+A\n@SP\nD=M-D\n@ARG\nM=D\n'
+                   # set LCL = SP
+                   + '@SP\nD=M\n@LCL\nM=D\n'
+                   # transfer control to called function/ goto functionName, and declare the return address label
+                   + f'@{functionName}\n0;JMP\n' + f"({return_label})\n")
+        self.flushIfFull()
 
-        # push ARG
-        self.outfile.write('@ARG\nD=M\n' + '@SP\nA=M\nM=D\n@SP\nM=M+1\n')
+    push_frame_pointers = ''.join(f'@{register}\nD=M\n' + '@SP\nA=M\nM=D\n@SP\nM=M+1\n'
+                                  for register in ('LCL', 'ARG', 'THIS', 'THAT'))
 
-        # push THIS
-        self.outfile.write('@THIS\nD=M\n' + '@SP\nA=M\nM=D\n@SP\nM=M+1\n') 
+    def writeCallRoutine(self):
+        # the shared call routine: expects the function address in R13, numArgs in R14 and the return address in D
+        self.write('(VM$CALL)\n')
 
-        # push THAT
-        self.outfile.write('@THAT\nD=M\n' + '@SP\nA=M\nM=D\n@SP\nM=M+1\n')    
+        # push return address, LCL, ARG, THIS, THAT
+        self.write('@SP\nA=M\nM=D\n@SP\nM=M+1\n' + self.push_frame_pointers)
 
         # set ARG to SP-numArgs-5
-        self.outfile.write(f'@{numArgs}\nD=A\n@5\nD=D+A\n@SP\nD=M-D\n@ARG\nM=D\n' )
+        self.write('@R14\nD=M\n@5\nD=D+A\n@SP\nD=M-D\n@ARG\nM=D\n')
 
         # set LCL = SP
-        self.outfile.write('@SP\nD=M\n@LCL\nM=D\n')
+        self.write('@SP\nD=M\n@LCL\nM=D\n')
 
-        # transfer control to called function/ goto functionName
-        self.outfile.write(f'@{functionName}\n0;JMP\n')
+        # goto the function
+        self.write('@R13\nA=M\n0;JMP\n')
 
-        # declare label for the return address
-        self.outfile.write(f"({return_label})\n")
+    def useRoutine(self, name):
+        # records that the code refers to one of the shared routines
+        if name not in self.used_routines:
+            self.used_routines.append(name)
+
+    def writeRoutines(self):
+        # writes the shared routines the code used. they are placed behind an endless loop so that a program that
+        # runs off its end stops there instead of running into them
+        if len(self.used_routines) == 0:
+            return
+        self.write('(VM$HALT)\n@VM$HALT\n0;JMP\n')
+        for name in self.used_routines:
+            if name == 'VM$CALL':
+                self.writeCallRoutine()
+            elif name == 'VM$RETURN':
+                self.write('(VM$RETURN)\n')
+                self.writeReturnFrame()
+            elif name in self.compare_routines.values():
+                self.writeCompareRoutine(name)
     
     def writeReturn(self):
-        # r15 is used to store 'frame'/ LCL's current value
-        self.outfile.write('@LCL\nD=M\n@15\nM=D\n')
+        if self.trampolines:
+            self.useRoutine('VM$RETURN')
+            self.write('@VM$RETURN\n0;JMP\n')
+            return
+        self.writeReturnFrame()
 
-        # r14 is used to store the return address
-        self.outfile.write('@5\nA=D-A\nD=M\n@14\nM=D\n')
+    def writeReturnFrame(self):
+        # the code of a return: restores the caller's frame and jumps to the return address
+        # r15 is used to store 'frame'/ LCL's current value, r14 is used to store the return address
+        self.write('@LCL\nD=M\n@15\nM=D\n' + '@5\nA=D-A\nD=M\n@14\nM=D\n')
 
         # take the return value from the function and place it at the arg 0 position
         self.writePushPop('C_POP', 'argument', 0)
 
         # restore stack pointer to arg 1 position
-        self.outfile.write('@ARG\nD=M+1\n@SP\nM=D\n')
+        self.write('@ARG\nD=M+1\n@SP\nM=D\n'
+                   # restore THAT
+                   '@R15\nA=M-1\nD=M\n@THAT\nM=D\n'
+                   # restore THIS
+                   '@R15\nD=M\n@2\nA=D-A\nD=M\n@THIS\nM=D\n'
+                   # restore ARG
+                   '@R15\nD=M\n@3\nA=D-A\nD=M\n@ARG\nM=D\n'
+                   # restore LCL
+                   '@R15\nD=M\n@4\nA=D-A\nD=M\n@LCL\nM=D\n'
+                   # goto return address
+                   '@R14\nA=M\n0;JMP\n')
 
-        # restore THAT
-        self.outfile.write('@R15\nA=M-1\nD=M\n@THAT\nM=D\n')
 
-        # restore THIS
-        self.outfile.write('@R15\nD=M\n@2\nA=D-A\nD=M\n@THIS\nM=D\n')
+    def close(self):
+        self.writeRoutines()
+        self.flush()
+        if self.asmfile is not None:
+            self.asmfile.close()
+
+class StackCachingCodeWriter(CodeWriter):
+    # a CodeWriter that keeps the top of the stack in the D register between commands instead of always writing it
+    # back to RAM[SP-1] and reloading it with @SP AM=M-1 D=M in the next command.
+    # while tos_in_d is set the value on top of the stack is in D and SP does not count it. it is spilled to RAM
+    # (pushed) only where the stack has to be in memory: before labels, gotos, calls and returns, since code
+    # jumping to a label or a function can't know what D holds
+    def __init__(self, outfilename, optimize=False, trampolines=False, shared_compare=False):
+        CodeWriter.__init__(self, outfilename, optimize, trampolines, shared_compare)
+        self.tos_in_d = False
+
+    segment_symbols = {'local': 'LCL', 'argument': 'ARG', 'this': 'THIS', 'that': 'THAT'}
+    fixed_bases = {'temp': 5, 'pointer': 3}
+
+    def spill(self):
+        # writes a cached top of stack back to RAM
+        if self.tos_in_d:
+            self.write('@SP\nA=M\nM=D\n@SP\nM=M+1\n')
+            self.tos_in_d = False
+
+    def load(self):
+        # makes sure the top of the stack is in D, popping it from RAM if it isn't
+        if not self.tos_in_d:
+            self.write('@SP\nAM=M-1\nD=M\n')
+            self.tos_in_d = True
+
+    def newLabel(self):
+        # returns a label that has not been used previously
+        label = self.logic_available_label
+        self.logic_label_number += 1
+        self.logic_available_label = f"{self.label_namespace}VMLABEL{self.logic_label_number}"
+        return label
 
-        # restore ARG
-        self.outfile.write('@R15\nD=M\n@3\nA=D-A\nD=M\n@ARG\nM=D\n')
+    def writeArithmetic(self, command):
+        # the operands are popped into D and M and the result is left in D, as the new cached top of stack
+        # eq, gt and lt stay inline even with shared_compare set: with the operand already in D the comparison
+        # takes 8 instructions, fewer than spilling and calling a shared routine would
+        self.load()
+        if command == 'neg':
+            self.write('D=-D\n')
+        elif command == 'not':
+            self.write('D=!D\n')
+        elif command in ('add', 'sub', 'and', 'or'):
+            operation = {'add': 'D=D+M', 'sub': 'D=M-D', 'and': 'D=D&M', 'or': 'D=D|M'}[command]
+            self.write('@SP\nAM=M-1\n' + operation + '\n')
+        elif command in ('eq', 'gt', 'lt'):
+            true_label = self.newLabel()
+            end_label = self.newLabel()
+            jump = {'eq': 'JEQ', 'gt': 'JGT', 'lt': 'JLT'}[command]
+            self.write('@SP\nAM=M-1\nD=M-D\n' + f'@{true_label}\nD;{jump}\n' + 'D=0\n' + f'@{end_label}\n0;JMP\n'
+                               + f'({true_label})\n' + 'D=-1\n' + f'({end_label})\n')
+        else:
+            raise Exception("Arithmetic Command Not Found")
 
-        # restore LCL
-        self.outfile.write('@R15\nD=M\n@4\nA=D-A\nD=M\n@LCL\nM=D\n')
+    def writePushPop(self, command, segment, index):
+        if command == 'C_PUSH':
+            self.spill()
+            if segment == 'constant':
+                if index in (0, 1):
+                    self.write(f'D={index}\n')
+                else:
+                    self.write(f'@{index}\nD=A\n')
+            elif segment in self.fixed_bases:
+                self.write(f'@{self.fixed_bases[segment] + index}\nD=M\n')
+            elif segment == 'static':
+                self.write(f"@{self.static_prefix}.{index}\n" + 'D=M\n')
+            elif segment in self.segment_symbols:
+                symbol = self.segment_symbols[segment]
+                if index == 0:
+                    self.write(f'@{symbol}\nA=M\nD=M\n')
+                elif index == 1:
+                    self.write(f'@{symbol}\nA=M+1\nD=M\n')
+                else:
+                    self.write(f'@{index}\nD=A\n@{symbol}\nA=D+M\nD=M\n')
+            else:
+                raise Exception('Push Command Not Found')
+            self.tos_in_d = True
 
-        # goto return address
-        self.outfile.write('@R14\nA=M\n0;JMP\n')
+        elif command == 'C_POP':
+            self.load()
+            if segment in self.fixed_bases:
+                self.write(f'@{self.fixed_bases[segment] + index}\nM=D\n')
+            elif segment == 'static':
+                self.write(f"@{self.static_prefix}.{index}\n" + 'M=D\n')
+            elif segment in self.segment_symbols:
+                symbol = self.segment_symbols[segment]
+                if index <= PeepholeOptimizer.max_stepped_offset:
+                    steps = 'A=M\n' if index == 0 else 'A=M+1\n' + 'A=A+1\n' * (index - 1)
+                    self.write(f'@{symbol}\n' + steps + 'M=D\n')
+                else:
+                    # D has to survive computing the address: park it in R13 and the address in R14
+                    self.write(f'@R13\nM=D\n@{index}\nD=A\n@{symbol}\nD=D+M\n@R14\nM=D\n'
+                                       + '@R13\nD=M\n@R14\nA=M\nM=D\n')
+            else:
+                raise Exception('Pop Command Not Found')
+            self.tos_in_d = False
+        else:
+            raise Exception('Push Pop Command Not Found')
 
+    def writeLabel(self, label):
+        self.spill()
+        CodeWriter.writeLabel(self, label)
 
-    def close(self):
-        self.outfile.close()
+    def writeGoto(self, label):
+        self.spill()
+        CodeWriter.writeGoto(self, label)
 
-##########################################################
+    def writeIf(self, label):
+        self.load()
+        self.write('@' + self.label_prefix + label + '\nD;JNE\n')
+        self.tos_in_d = False
 
-infile = ''
-inname = sys.argv[1]
-cwdfiles = os.listdir('.')
-vm_program_folder = []
+    def writeFunction(self, functionName, numLocals):
+        # a function is entered with the whole stack in RAM
+        self.tos_in_d = False
+        CodeWriter.writeFunction(self, functionName, numLocals)
+
+    def writeCall(self, functionName, numArgs):
+        self.spill()
+        CodeWriter.writeCall(self, functionName, numArgs)
 
-if f'{inname}.vm' in cwdfiles:
-    infile = inname
-    parser = Parser(infile)
-else:
-    vm_program_folder = os.listdir(inname)
+    def writeReturn(self):
+        self.spill()
+        CodeWriter.writeReturn(self)
+        self.tos_in_d = False
+
+    def writeRoutines(self):
+        # the shared routines start with the whole stack in RAM
+        self.tos_in_d = False
+        CodeWriter.writeRoutines(self)
+
+##########################################################
+
+# the CodeWriter method that translates each type of command
+command_writers = {
+    'C_ARITHMETIC': lambda code_writer, command: code_writer.writeArithmetic(command.arg1),
+    'C_PUSH': lambda code_writer, command: code_writer.writePushPop('C_PUSH', command.arg1, command.arg2),
+    'C_POP': lambda code_writer, command: code_writer.writePushPop('C_POP', command.arg1, command.arg2),
+    'C_LABEL': lambda code_writer, command: code_writer.writeLabel(command.arg1),
+    'C_GOTO': lambda code_writer, command: code_writer.writeGoto(command.arg1),
+    'C_IF': lambda code_writer, command: code_writer.writeIf(command.arg1),
+    'C_FUNCTION': lambda code_writer, command: code_writer.writeFunction(command.arg1, command.arg2),
+    'C_CALL': lambda code_writer, command: code_writer.writeCall(command.arg1, command.arg2),
+    'C_RETURN': lambda code_writer, command: code_writer.writeReturn(),
+}
+
+def translate(parser, code_writer):
+    # translates every command of a parsed .vm file with the given CodeWriter
+    translateCommands(parser.commands, code_writer)
+
+def translateCommands(commands, code_writer):
+    # translates the commands of a .vm file, a list or a generator such as readCommands, with the given CodeWriter.
+    # the fragments are flushed between commands as well, so that code without labels doesn't pile up in memory
+    fragments = code_writer.fragments
+    flush_fragments = code_writer.command_flush_fragments
+    for command in commands:
+        command_writers[command.type](code_writer, command)
+        if len(fragments) >= flush_fragments:
+            code_writer.flush()
+
+def liveFunctions(parsers):
+    # returns the names of the functions that can be reached from Sys.init (or from code outside of any function)
+    # by following call commands through the parsed files of a program. returns None if the program has no Sys.init,
+    # since then there is no telling where it starts
+    calls = {}   # function name -> names of the functions it calls
+    roots = ['Sys.init']
+    for parser in parsers:
+        function = None
+        for command in parser.commands:
+            if command.type == 'C_FUNCTION':
+                function = command.arg1
+                calls[function] = []
+            elif command.type == 'C_CALL':
+                if function is None:
+                    roots.append(command.arg1)
+                else:
+                    calls[function].append(command.arg1)
+    if 'Sys.init' not in calls:
+        return None
+
+    live = set()
+    unvisited = roots
+    while len(unvisited) != 0:
+        function = unvisited.pop()
+        # a call to a function that isn't defined anywhere is left for the assembler to report
+        if function in live or function not in calls:
+            continue
+        live.add(function)
+        unvisited += calls[function]
+    return live
+
+def removeDeadFunctions(parser, live):
+    # drops every function of a parsed file that is not in live, before anything of it is translated
+    kept = []
+    keep = True
+    for command in parser.commands:
+        if command.type == 'C_FUNCTION':
+            keep = command.arg1 in live
+        if keep:
+            kept.append(command)
+    parser.commands = kept
+
+def linkProgram(parsers, filenames, dce=False, inline=False):
+    # the passes over the parsed files of a whole program, run before anything is translated: with inline set small
+    # functions are inlined, see Inliner, and with dce (or inline) set functions that are never called are removed.
+    # returns the Inliner used, if any
+    inliner = None
+    if inline:
+        inliner = Inliner()
+        inliner.inline(parsers, filenames)
+    if dce or inline:
+        live = liveFunctions(parsers)
+        if live is not None:
+            for parser in parsers:
+                removeDeadFunctions(parser, live)
+    return inliner
+
+def translateFile(task):
+    # translates one .vm file with a CodeWriter of its own and returns the finished assembly, the shared routines it
+    # uses and the optimizer's instruction counts. runs inside a worker process. parser is the parsed file when the
+    # main process has already parsed and linked the program, otherwise None and the file is read here
+    path, filename, writer_class, optimize, trampolines, shared_compare, parser = task
+    code_writer = writer_class(None, optimize, trampolines, shared_compare)
+    code_writer.setFileName(filename)
+    if parser is None:
+        translateCommands(readCommands(path), code_writer)
+    else:
+        translate(parser, code_writer)
+    assembly = code_writer.getvalue()
+    counts = (0, 0)
+    if code_writer.optimizer is not None:
+        counts = (code_writer.optimizer.before, code_writer.optimizer.after)
+    return assembly, code_writer.used_routines, counts
+
+def translateFiles(code_writer, vm_program_folder, directory, parallel=False, workers=None, dce=False, inline=False):
+    # translates the files of a program with code_writer, one after another or, with parallel set, spread over a
+    # pool of worker processes. the assembly of the files is added in the order of vm_program_folder either way and
+    # the labels are numbered per file, so both give the same output.
+    # with dce or inline set the whole program is parsed and linked first, see linkProgram. returns the Inliner used
+    parsers = None
+    inliner = None
+    if dce or inline:
+        parsers = [Parser(os.path.join(directory, infile)) for infile in vm_program_folder]
+        inliner = linkProgram(parsers, vm_program_folder, dce, inline)
+
+    if not parallel:
+        for i, infile in enumerate(vm_program_folder):
+            code_writer.setFileName(infile)
+            if parsers is None:
+                # streamed: each command is translated as soon as it is read
+                translateCommands(readCommands(os.path.join(directory, infile)), code_writer)
+            else:
+                translate(parsers[i], code_writer)
+        return inliner
+
+    tasks = [(os.path.join(directory, infile), infile, type(code_writer), code_writer.optimizer is not None,
+              code_writer.trampolines, code_writer.shared_compare, None if parsers is None else parsers[i])
+             for i, infile in enumerate(vm_program_folder)]
+    pool = ProcessPoolExecutor(max_workers=workers)
+    # hand the files out a few at a time, a directory can have hundreds of small ones
+    chunksize = max(1, len(tasks) // (4 * (workers or os.cpu_count())))
+    for assembly, routines, (before, after) in pool.map(translateFile, tasks, chunksize=chunksize):
+        code_writer.writeTranslated(assembly, routines)
+        if code_writer.optimizer is not None:
+            code_writer.optimizer.before += before
+            code_writer.optimizer.after += after
+    pool.shutdown()
+    return inliner
+
+def programFiles(inname, extension='.vm'):
+    # returns the names (without .vm) of the files making up the program inname, in translation order, and the
+    # directory they are in. inname is either a .vm file in the current directory (given without its extension) or
+    # a directory of .vm files, in which case Sys comes first and the others follow in name order.
+    # the Jack files of a program are found the same way by passing extension='.jack'
+    if f'{inname}{extension}' in os.listdir('.'):
+        return [inname], '.'
+
+    vm_program_folder = sorted(os.listdir(inname))
     vm_program_folder = [os.path.splitext(file) for file in vm_program_folder]
-    vm_program_folder = [file[0] for file in vm_program_folder if file[1] == '.vm']
-    os.chdir(inname)
+    vm_program_folder = [file[0] for file in vm_program_folder if file[1] == extension]
     if 'Sys' in vm_program_folder:
-        infile = 'Sys'
         vm_program_folder.remove('Sys')
+        vm_program_folder.insert(0, 'Sys')
+    return vm_program_folder, inname
+
+def main():
+    # python VM.py Prog translates Prog.vm or the directory Prog into Prog.asm. passing -O runs the peephole
+    # optimizer over the output and prints the instruction count before and after. passing --trampolines makes
+    # calls and returns go through shared routines, passing --shared-compare does the same for eq, gt and lt,
+    # passing --cache-tos keeps the top of the stack in D. passing -j N translates the files of a directory in N
+    # worker processes. passing --dce leaves out the functions that can't be reached from Sys.init, passing --inline
+    # replaces calls to small functions with their body (and leaves out the functions no longer called)
+    inname = sys.argv[1]
+    optimize = '-O' in sys.argv[2:]
+    trampolines = '--trampolines' in sys.argv[2:]
+    shared_compare = '--shared-compare' in sys.argv[2:]
+    parallel = '-j' in sys.argv[2:]
+    workers = None
+    if parallel:
+        workers = int(sys.argv[sys.argv.index('-j') + 1])
+    vm_program_folder, directory = programFiles(inname)
+
+    if '--cache-tos' in sys.argv[2:]:
+        code_writer = StackCachingCodeWriter(inname, optimize, trampolines, shared_compare)
     else:
-        infile = vm_program_folder[0]
-        vm_program_folder.pop(0)
-    parser = Parser(infile)
-    os.chdir('../')
-
-code_writer = CodeWriter(inname)
-code_writer.setFileName(infile)
-
-##### VM Bootstrap Code #####
-
-# # Set SP to 256
-code_writer.outfile.write('@256\nD=A\n@SP\nM=D\n')
-
-# # Call Sys.init
-code_writer.writeCall('Sys.init', 0)
-
-##### VM Bootstrap Code #####
-
-while parser.hasMoreCommands():
-    parser.advance()
-    commandType = parser.commandType()
-    if commandType == 'C_ARITHMETIC':
-        code_writer.writeArithmetic(parser.arg1())
-    if commandType == 'C_PUSH' or commandType == 'C_POP':
-        code_writer.writePushPop(commandType, parser.arg1(), parser.arg2())
-
-    if commandType == 'C_LABEL':
-        code_writer.writeLabel(parser.arg1())
-    if commandType == 'C_GOTO':
-        code_writer.writeGoto(parser.arg1())
-    if commandType == 'C_IF':
-        code_writer.writeIf(parser.arg1())    
-    
-    if commandType == 'C_FUNCTION':
-        code_writer.writeFunction(parser.arg1(), parser.arg2())
-    if commandType == 'C_CALL':
-        code_writer.writeCall(parser.arg1(), parser.arg2())
-    if commandType == 'C_RETURN':
-        code_writer.writeReturn()
-
-if len(vm_program_folder) == 0:
-    code_writer.close()
-else:
-    while len(vm_program_folder) != 0:
-        infile = vm_program_folder[0]
-        vm_program_folder.pop(0)
-        os.chdir(inname)
-        parser = Parser(infile)
-        os.chdir('../')
-        code_writer.setFileName(infile)
-        while parser.hasMoreCommands():
-            parser.advance()
-            commandType = parser.commandType()
-            if commandType == 'C_ARITHMETIC':
-                code_writer.writeArithmetic(parser.arg1())
-            if commandType == 'C_PUSH' or commandType == 'C_POP':
-                code_writer.writePushPop(commandType, parser.arg1(), parser.arg2())
-
-            if commandType == 'C_LABEL':
-                code_writer.writeLabel(parser.arg1())
-            if commandType == 'C_GOTO':
-                code_writer.writeGoto(parser.arg1())
-            if commandType == 'C_IF':
-                code_writer.writeIf(parser.arg1())    
-            
-            if commandType == 'C_FUNCTION':
-                code_writer.writeFunction(parser.arg1(), parser.arg2())
-            if commandType == 'C_CALL':
-                code_writer.writeCall(parser.arg1(), parser.arg2())
-            if commandType == 'C_RETURN':
-                code_writer.writeReturn()
+        code_writer = CodeWriter(inname, optimize, trampolines, shared_compare)
+
+    code_writer.writeInit()
+    inliner = translateFiles(code_writer, vm_program_folder, directory, parallel, workers, '--dce' in sys.argv[2:],
+                             '--inline' in sys.argv[2:])
     code_writer.close()
 
+    if inliner is not None:
+        print(f'{inliner.inlined} calls inlined')
+
+    if optimize:
+        optimizer = code_writer.optimizer
+        print(f'{optimizer.before} instructions before optimizing, {optimizer.after} after '
+              f'({100 * (optimizer.before - optimizer.after) / max(optimizer.before, 1):.1f}% smaller)')
 
+if __name__ == '__main__':
+    main()
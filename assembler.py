@@ -1,91 +1,120 @@
-import os, sys
+import os, sys, io, mmap, glob, time, hashlib, json
+from concurrent.futures import ProcessPoolExecutor
+from array import array
 
 # To translate from assembly to machine code:
-# First change working directory to the directory containing the .asm file.
-# Then run the assembler with the name of the file to be translated as the first command line argument.
-# the .hack file will be generated in the current working directory
+# Run the assembler with the path of the file to be translated as the first command line argument (the .asm
+# extension may be left out). The .hack file will be generated next to the .asm file.
+# Passing -b after the file name writes a binary ROM image (.rom) instead: one little-endian uint16 per instruction.
+# If the first argument is a directory or a glob pattern (quote it so the shell leaves it alone) every .asm file it
+# matches is assembled, one file per worker process. -j N sets the number of worker processes.
+#
+# The assembler can also be imported: assemble() translates assembly source held in memory and assembleFile()
+# translates a file. Neither keeps any state between calls or depends on the current working directory.
+# Passing -i assembles incrementally: the encoded words of every chunk of code between two labels are cached on disk
+# (in a .hackcache file next to the output) keyed by the chunk's content, and only chunks that changed are encoded.
+
+class Instruction:
+    # one assembly command parsed into its parts. every line is split up exactly once, when it is read, and the
+    # passes of the assembler (and any other tool working on assembly) only read these fields afterwards
+    __slots__ = ('kind', 'text', 'symbol', 'value', 'dest', 'comp', 'jump')
+
+    def __init__(self, text):
+        self.text = text
+        self.symbol = None  # symbol or decimal of an A or L command
+        self.value = None   # value of an A command given as a decimal
+        self.dest = None
+        self.comp = None
+        self.jump = None
+
+        if text[0] == '@':
+            self.kind = 'A_COMMAND'
+            self.symbol = text[1:]
+            if self.symbol.isdigit():
+                self.value = int(self.symbol)
+                if self.value > 32767:
+                    raise Exception(f'Constant too large for an A instruction, at most 32767: {text}')
+        elif text[0] == '(':
+            self.kind = 'L_COMMAND'
+            self.symbol = text[1:-1]
+        else:
+            self.kind = 'C_COMMAND'
+            equalindex = text.find('=')
+            colonindex = text.find(';')
+            if colonindex == -1:
+                self.jump = 'null'
+                self.comp = text[equalindex + 1:]
+            else:
+                self.jump = text[colonindex + 1:]
+                self.comp = text[equalindex + 1:colonindex]
+            self.dest = 'null' if equalindex == -1 else text[:equalindex]
+
+def parseInstructions(lines):
+    # generator that strips comments (whole line or trailing) and whitespace from the lines of an assembly program,
+    # skips empty lines and yields every remaining command as an Instruction.
+    # Instructions are never modified once parsed, so a line that occurs many times (@SP, M=M+1, ...) is parsed
+    # once and the same Instruction is yielded for every occurrence
+    parsed = {}
+    for line in lines:
+        comment = line.find('//')
+        if comment != -1:
+            line = line[:comment]
+        line = line.strip()
+        if line != '':
+            instruction = parsed.get(line)
+            if instruction is None:
+                instruction = Instruction(line)
+                parsed[line] = instruction
+            yield instruction
 
 class Parser:
-    def __init__(self, infilename):
-        # opens input file and gets ready to parse it
-        self.infilename = infilename
-        self.infile = []
-
-        # cleaning up any comments and empty lines in the input file and storing each line in an array
-        infile = open(self.infilename + '.asm')
-        for line in infile:
-            line = line.strip()
-            if line != '':
-                if line[0] != '/':
-                    newlinechar = line.find('\n')
-                    if newlinechar != -1:
-                        line = line[:newlinechar] + line[newlinechar + 2:]
-                    self.infile.append(line)
-        infile.close()
-
-        self.totalcommandcount = len(self.infile)
-        self.currentcommandcount = 0
+    def __init__(self, lines):
+        # takes the lines of an assembly program (an open file or any iterable of strings) and gets ready to parse it.
+        # lines are read one at a time as the parser is advanced, the program is never held in memory as a whole
+        self.instructions = parseInstructions(lines)
+        self.nextinstruction = next(self.instructions, None)
+        self.currentinstruction = None
         self.currentcommand = ''
-        
+
     def hasMoreCommands(self):
         # checks if there are more commands left to be parsed
-        if(self.currentcommandcount < self.totalcommandcount):
-            return True
-        return False
+        return self.nextinstruction is not None
 
     def advance(self):
         # reads the next command of the input and makes it the current command
-        self.currentcommand = self.infile[self.currentcommandcount]
-        self.currentcommandcount += 1
+        self.currentinstruction = self.nextinstruction
+        self.currentcommand = self.currentinstruction.text
+        self.nextinstruction = next(self.instructions, None)
 
     def commandType(self):
         # returns the type of the current command
-        if self.currentcommandcount == 0:
+        if self.currentinstruction is None:
             raise Exception('Please advance the parser to the first command before calling this method')
-        if self.currentcommand[0] == '@':
-            return 'A_COMMAND'
-        if self.currentcommand[0] == '(':
-            return 'L_COMMAND'
-        return 'C_COMMAND'
+        return self.currentinstruction.kind
 
     def symbol(self):
         # returns the symbol or the decimal of the current A or L command
-        if self.commandType() == 'A_COMMAND':
-            return self.currentcommand[1:]
-        if self.commandType() == 'L_COMMAND':
-            return self.currentcommand[1:-1]
-        raise Exception('This method can only be called if the current command is of type A_COMMAND or L_COMMAND')
+        if self.commandType() == 'C_COMMAND':
+            raise Exception('This method can only be called if the current command is of type A_COMMAND or L_COMMAND')
+        return self.currentinstruction.symbol
 
     def dest(self):
         # returns the dest mnemonic in the current C_COMMAND
-        if self.commandType() == 'C_COMMAND':
-            equalindex = self.currentcommand.find('=')
-            if equalindex == -1:
-                return 'null'
-            return self.currentcommand[:equalindex]
-        raise Exception("This method can only be called if the current command is of type C_COMMAND")
+        if self.commandType() != 'C_COMMAND':
+            raise Exception("This method can only be called if the current command is of type C_COMMAND")
+        return self.currentinstruction.dest
 
     def comp(self):
         # returns the comp mnemonic in the current C_COMMAND
-        if self.commandType() == 'C_COMMAND':
-            equalindex = self.currentcommand.find('=')
-            colonindex = self.currentcommand.find(';')
-            if (equalindex != -1) & (colonindex != -1):
-                return self.currentcommand[equalindex + 1:colonindex]
-            if colonindex != -1:
-                return self.currentcommand[:colonindex]
-            if equalindex != -1:
-                return self.currentcommand[equalindex + 1:]  
-        raise Exception("This method can only be called if the current command is of type C_COMMAND")
+        if self.commandType() != 'C_COMMAND':
+            raise Exception("This method can only be called if the current command is of type C_COMMAND")
+        return self.currentinstruction.comp
 
     def jump(self):
         # returns the jump mnemonic in the current C_COMMAND
-        if self.commandType() == 'C_COMMAND':
-            colonindex = self.currentcommand.find(';')
-            if colonindex == -1:
-                return 'null'
-            return self.currentcommand[colonindex + 1:]
-        raise Exception("This method can only be called if the current command is of type C_COMMAND")
+        if self.commandType() != 'C_COMMAND':
+            raise Exception("This method can only be called if the current command is of type C_COMMAND")
+        return self.currentinstruction.jump
 
 class Code:
     def __init__(self):
@@ -139,6 +168,15 @@ class Code:
                           'D&M': '1000000',
                           'D|M': '1010101',
                           }
+
+        # the same tables as integers already shifted into their place in a 16-bit C instruction word
+        self.destwords = {mnemonic: int(bits, 2) << 3 for mnemonic, bits in self.desttable.items()}
+        self.jumpwords = {mnemonic: int(bits, 2) for mnemonic, bits in self.jumptable.items()}
+        self.compwords = {mnemonic: (0b111 << 13) | (int(bits, 2) << 6) for mnemonic, bits in self.comptable.items()}
+
+        # finished words of C instructions that have already been encoded, keyed by the instruction text
+        self.wordcache = {}
+
     def dest(self, input):
         return self.desttable[input]
 
@@ -148,6 +186,18 @@ class Code:
     def jump(self, input):
          return self.jumptable[input]
 
+    def cInstruction(self, dest, comp, jump):
+        # returns the 16-bit C instruction word for the given mnemonics
+        return self.compwords[comp] | self.destwords[dest] | self.jumpwords[jump]
+
+    def encode(self, instruction):
+        # returns the word of a C command Instruction, encoding each distinct instruction text only once
+        word = self.wordcache.get(instruction.text)
+        if word is None:
+            word = self.cInstruction(instruction.dest, instruction.comp, instruction.jump)
+            self.wordcache[instruction.text] = word
+        return word
+
 class SymbolTable:
     def __init__(self):
         self.table = {
@@ -189,62 +239,349 @@ class SymbolTable:
     def getAddress(self, symbol):
         return self.table[symbol]
         
-asmfile = sys.argv[1] # name of .asm file to be converted taken in as command line argument
-coder = Code()
-symbols = SymbolTable()
-hackfile = open(asmfile + '.hack', 'w')
-
-firstparse = Parser(asmfile)
-commandcount = 0
-
-while firstparse.hasMoreCommands():
-    firstparse.advance()
-    if firstparse.commandType() == 'L_COMMAND':
-        address = commandcount 
-        symbol = firstparse.symbol()
+def openAtomic(filename, mode):
+    # opens a temporary file next to filename. closing it with closeAtomic moves it into place in one step, so
+    # readers never see a half written output file. the file is created with the permissions open() would give it,
+    # the process umask applies as usual
+    directory, name = os.path.split(filename)
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+    while True:
+        temporaryname = os.path.join(directory, f'.{name}.{os.urandom(4).hex()}.tmp')
+        try:
+            handle = os.open(temporaryname, flags, 0o666)
+        except FileExistsError:
+            continue
+        return os.fdopen(handle, mode), temporaryname
+
+def closeAtomic(outfile, temporaryname, filename):
+    outfile.close()
+    os.replace(temporaryname, filename)
+
+def writeRom(romfilename, words):
+    # writes instruction words as a packed little-endian uint16 ROM image
+    rom = array('H', words)
+    if sys.byteorder == 'big':
+        rom.byteswap()
+    romfile, temporaryname = openAtomic(romfilename, 'wb')
+    rom.tofile(romfile)
+    closeAtomic(romfile, temporaryname, romfilename)
+
+def readRom(romfilename):
+    # memory-maps a binary ROM image and returns its instruction words as a sequence of ints.
+    # the words are read straight from the mapping, the file is never parsed or copied on little-endian machines.
+    romfile = open(romfilename, 'rb')
+    size = os.fstat(romfile.fileno()).st_size
+    if size == 0:
+        romfile.close()
+        return array('H')
+    if size % 2 != 0:
+        romfile.close()
+        raise Exception('ROM image size must be a whole number of 16-bit words')
+    mapping = mmap.mmap(romfile.fileno(), 0, access=mmap.ACCESS_READ)
+    romfile.close()
+    if sys.byteorder == 'big':
+        rom = array('H', mapping)
+        rom.byteswap()
+        mapping.close()
+        return rom
+    return memoryview(mapping).cast('H')
+
+def sourceLines(source):
+    # turns program text (str or bytes) into something that yields its lines. anything else is assumed to already
+    # be an iterable of lines and is returned as it is
+    if isinstance(source, bytes):
+        source = source.decode()
+    if isinstance(source, str):
+        source = io.StringIO(source)
+    return source
+
+def assemble(source, coder=None):
+    # translates a Hack assembly program to machine code and returns the instruction words as an array('H').
+    # source is the program text (str or bytes) or an iterable of its lines.
+    # a Code instance can be passed in so that its encoding cache is reused across calls.
+    if coder is None:
+        coder = Code()
+    source = sourceLines(source)
+    symbols = SymbolTable()
+
+    # single pass: the source is read once and every instruction is emitted into an in-memory buffer.
+    # an A command naming a symbol that is not yet known is left as a placeholder and its position is recorded,
+    # it is backpatched when the matching (LABEL) declaration is reached.
+    hackbuffer = array('H')
+    forwardrefs = {} # symbol -> positions in hackbuffer waiting for the symbol's address
+
+    for instruction in parseInstructions(source):
+        kind = instruction.kind
+        if kind == 'A_COMMAND':
+            if instruction.value is not None:
+                hackbuffer.append(instruction.value)
+            elif symbols.contains(instruction.symbol):
+                hackbuffer.append(symbols.getAddress(instruction.symbol))
+            else:
+                forwardrefs.setdefault(instruction.symbol, []).append(len(hackbuffer))
+                hackbuffer.append(0)
+        elif kind == 'L_COMMAND':
+            address = len(hackbuffer)
+            symbols.addEntry(instruction.symbol, address)
+            for position in forwardrefs.pop(instruction.symbol, ()):
+                hackbuffer[position] = address
+        else:
+            hackbuffer.append(coder.encode(instruction))
+
+    # symbols that never got declared as labels are variables. they are allocated in order of first use,
+    # which is the same order the two pass version allocated them in.
+    for symbol, positions in forwardrefs.items():
+        address = symbols.available_ram_address
         symbols.addEntry(symbol, address)
-        continue
-    commandcount += 1
-
-secondparse = Parser(asmfile)
-
-while secondparse.hasMoreCommands():
-    secondparse.advance()
-    if secondparse.commandType() == 'A_COMMAND':
-        symbol = secondparse.symbol()
-        if symbol.isdigit():
-            aregister1 = bin(int(symbol))[2:].zfill(15)
-            hackfile.write('0' + aregister1 + '\n')
-        elif symbols.contains(symbol):
-            address = symbols.getAddress(symbol)
-            aregister2 = bin(address)[2:].zfill(15)
-            hackfile.write('0' + aregister2 + '\n')
+        symbols.available_ram_address += 1
+        for position in positions:
+            hackbuffer[position] = address
+
+    return hackbuffer
+
+# bump this when the layout of the incremental cache changes so that old cache files are ignored
+cacheversion = 2
+
+def encodeChunk(instructions, coder):
+    # encodes a chunk of A and C command Instructions that contains no labels. symbols other than the predefined
+    # ones can not be resolved yet, their words are left as 0 and returned as relocations: a list of (offset, symbol)
+    predefined = SymbolTable()
+    words = array('H')
+    relocations = []
+    for instruction in instructions:
+        if instruction.kind == 'A_COMMAND':
+            if instruction.value is not None:
+                words.append(instruction.value)
+            elif predefined.contains(instruction.symbol):
+                words.append(predefined.getAddress(instruction.symbol))
+            else:
+                relocations.append((len(words), instruction.symbol))
+                words.append(0)
+        else:
+            words.append(coder.encode(instruction))
+    return words.tobytes(), relocations
+
+# an incremental assembly cache file is a line of JSON describing the cache followed by the raw bytes of the words,
+# first those of the whole program (if it was saved) and then those of every chunk in the order the JSON lists them:
+#     {"version": 2, "program": [digest, word count] or null, "chunks": [[digest, word count, relocations], ...]}
+# digests are written in hex and relocations as [offset, symbol] pairs. it only holds data, so a cache file someone
+# else wrote can at worst give wrong words, and anything that doesn't fit this layout is ignored
+
+def loadCache(cachefilename):
+    # reads an incremental assembly cache, returns an empty cache if there is none or it can't be used
+    emptycache = {'program': None, 'chunks': {}}
+    try:
+        cachefile = open(cachefilename, 'rb')
+    except OSError:
+        return emptycache
+    try:
+        header = json.loads(cachefile.readline())
+        wordbytes = cachefile.read()
+    except Exception:
+        return emptycache
+    finally:
+        cachefile.close()
+
+    position = 0
+    def takeWords(count):
+        # the bytes of the next count words
+        nonlocal position
+        if not isinstance(count, int) or count < 0 or position + 2 * count > len(wordbytes):
+            raise ValueError('cache file is too short')
+        position += 2 * count
+        return wordbytes[position - 2 * count:position]
+
+    try:
+        if header['version'] != cacheversion:
+            return emptycache
+        program = None
+        if header['program'] is not None:
+            digest, count = header['program']
+            program = (bytes.fromhex(digest), takeWords(count))
+        chunks = {}
+        for digest, count, chunkrelocations in header['chunks']:
+            relocations = [(offset, symbol) for offset, symbol in chunkrelocations]
+            if not all(isinstance(offset, int) and 0 <= offset < count and isinstance(symbol, str)
+                       for offset, symbol in relocations):
+                raise ValueError('bad relocation')
+            chunks[bytes.fromhex(digest)] = (takeWords(count), relocations)
+        if position != len(wordbytes):
+            raise ValueError('cache file is too long')
+    except Exception:
+        return emptycache
+    return {'program': program, 'chunks': chunks}
+
+def saveCache(cachefilename, cache):
+    # writes an incremental assembly cache
+    program = cache['program']
+    header = {'version': cacheversion, 'program': None, 'chunks': []}
+    wordbytes = []
+    if program is not None:
+        header['program'] = [program[0].hex(), len(program[1]) // 2]
+        wordbytes.append(program[1])
+    for digest, (chunkbytes, relocations) in cache['chunks'].items():
+        header['chunks'].append([digest.hex(), len(chunkbytes) // 2, relocations])
+        wordbytes.append(chunkbytes)
+
+    cachefile, temporaryname = openAtomic(cachefilename, 'wb')
+    cachefile.write(json.dumps(header, separators=(',', ':')).encode() + b'\n')
+    cachefile.write(b''.join(wordbytes))
+    closeAtomic(cachefile, temporaryname, cachefilename)
+
+def programDigest(source):
+    # hashes the raw text of a program given as text, bytes or a seekable file, reading files in blocks and
+    # rewinding them afterwards. returns None for other iterables, which can only be read once
+    programhash = hashlib.blake2b(digest_size=16)
+    if isinstance(source, str):
+        programhash.update(source.encode())
+    elif isinstance(source, bytes):
+        programhash.update(source)
+    elif hasattr(source, 'seek'):
+        for block in iter(lambda: source.read(1 << 16), source.read(0)):
+            programhash.update(block.encode() if isinstance(block, str) else block)
+        source.seek(0)
+    else:
+        return None
+    return programhash.digest()
+
+def assembleIncremental(source, cachefilename, coder=None):
+    # translates a program like assemble() but reuses the work of the previous run recorded in the cache file.
+    # if the program is byte for byte the same its words are returned straight from the cache. otherwise the
+    # program is cut into chunks at every label and each chunk is looked up in the cache by the hash of its
+    # cleaned text, only new chunks get encoded. chunks keep their symbolic references as relocations, so unchanged
+    # chunks are reused even when labels before them moved: placing a chunk only costs patching its relocations.
+    if coder is None:
+        coder = Code()
+    cache = loadCache(cachefilename)
+    digest = programDigest(source)
+    if digest is not None and cache['program'] is not None and cache['program'][0] == digest:
+        hackbuffer = array('H')
+        hackbuffer.frombytes(cache['program'][1])
+        return hackbuffer
+
+    oldchunks = cache['chunks']
+    newchunks = {}
+    symbols = SymbolTable()
+    hackbuffer = array('H')
+    relocations = [] # (position in hackbuffer, symbol) in program order
+
+    def placeChunk(instructions):
+        chunktext = '\n'.join([instruction.text for instruction in instructions])
+        chunkdigest = hashlib.blake2b(chunktext.encode(), digest_size=16).digest()
+        chunk = newchunks.get(chunkdigest) or oldchunks.get(chunkdigest)
+        if chunk is None:
+            chunk = encodeChunk(instructions, coder)
+        newchunks[chunkdigest] = chunk
+        base = len(hackbuffer)
+        hackbuffer.frombytes(chunk[0])
+        for offset, symbol in chunk[1]:
+            relocations.append((base + offset, symbol))
+
+    instructions = []
+    for instruction in parseInstructions(sourceLines(source)):
+        if instruction.kind == 'L_COMMAND':
+            if instructions:
+                placeChunk(instructions)
+                instructions = []
+            symbols.addEntry(instruction.symbol, len(hackbuffer))
         else:
+            instructions.append(instruction)
+    if instructions:
+        placeChunk(instructions)
+
+    # labels are all known now, anything else is a variable allocated in order of first use
+    for position, symbol in relocations:
+        if not symbols.contains(symbol):
             symbols.addEntry(symbol, symbols.available_ram_address)
-            aregister3 = bin(symbols.available_ram_address)[2:].zfill(15)
-            hackfile.write('0' + aregister3 + '\n')
             symbols.available_ram_address += 1
-    
-    if secondparse.commandType() == 'C_COMMAND':
-        dest = coder.dest(secondparse.dest())
-        comp = coder.comp(secondparse.comp())
-        jump = coder.jump(secondparse.jump())
-        hackfile.write('111' + comp + dest + jump + '\n')
-    
-    continue
-
-hackfile.close()
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+        hackbuffer[position] = symbols.getAddress(symbol)
+
+    # only the chunks of this version of the program are kept so the cache doesn't grow without bound
+    program = None if digest is None else (digest, hackbuffer.tobytes())
+    saveCache(cachefilename, {'program': program, 'chunks': newchunks})
+    return hackbuffer
+
+def writeHack(hackfilename, words):
+    # writes instruction words as a text .hack file. words are only turned into text here, at the output
+    hackfile, temporaryname = openAtomic(hackfilename, 'w')
+    hackfile.write(''.join([format(word, '016b') + '\n' for word in words]))
+    closeAtomic(hackfile, temporaryname, hackfilename)
+
+def assembleFile(asmfilename, outfilename=None, binary=False, coder=None, incremental=False):
+    # translates the given .asm file (the extension may be left out) and writes the result next to it, or to
+    # outfilename if given. returns the instruction words.
+    # with incremental set the chunk cache is kept in a .hackcache file next to the output
+    base, extension = os.path.splitext(asmfilename)
+    if extension != '.asm':
+        base = asmfilename
+        asmfilename = asmfilename + '.asm'
+    if outfilename is None:
+        outfilename = base + ('.rom' if binary else '.hack')
+
+    asmfile = open(asmfilename)
+    if incremental:
+        words = assembleIncremental(asmfile, os.path.splitext(outfilename)[0] + '.hackcache', coder)
+    else:
+        words = assemble(asmfile, coder)
+    asmfile.close()
+
+    if binary:
+        writeRom(outfilename, words)
+    else:
+        writeHack(outfilename, words)
+    return words
+
+def assembleTask(task):
+    # assembles one file of a batch and returns how long it took and the error that stopped it, if any, so that one
+    # bad file doesn't abort the rest of the batch. runs inside a worker process
+    asmfilename, binary, incremental = task
+    start = time.perf_counter()
+    try:
+        assembleFile(asmfilename, binary=binary, incremental=incremental)
+    except Exception as error:
+        return asmfilename, time.perf_counter() - start, f'{type(error).__name__}: {error}'
+    return asmfilename, time.perf_counter() - start, None
+
+def assembleBatch(pattern, binary=False, workers=None, incremental=False):
+    # assembles every .asm file in a directory, or every file matching a glob pattern, spreading the files over a
+    # pool of worker processes. returns a list of (file name, seconds, error or None) in file name order
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, '*.asm')
+    asmfilenames = sorted(glob.glob(pattern))
+    if len(asmfilenames) == 0:
+        raise Exception(f'No .asm files found for {pattern}')
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(assembleTask, [(asmfilename, binary, incremental) for asmfilename in asmfilenames]))
+
+def isBatch(name):
+    # checks if a command line argument names a directory or a glob pattern rather than a single file.
+    # Prog is still the file Prog.asm when there is also a directory Prog, which is where VM.py leaves its output
+    if os.path.isfile(name) or os.path.isfile(name + '.asm'):
+        return False
+    return os.path.isdir(name) or any(char in name for char in '*?[')
+
+if __name__ == '__main__':
+    asmfile = sys.argv[1] # name of .asm file, directory or glob pattern taken in as command line argument
+    binary = '-b' in sys.argv[2:]
+    incremental = '-i' in sys.argv[2:]
+    workers = None
+    if '-j' in sys.argv[2:]:
+        workers = int(sys.argv[sys.argv.index('-j') + 1])
+
+    if isBatch(asmfile):
+        start = time.perf_counter()
+        timings = assembleBatch(asmfile, binary, workers, incremental)
+        failed = 0
+        for asmfilename, seconds, error in timings:
+            if error is None:
+                print(f'{asmfilename}: {seconds * 1000:.1f} ms')
+            else:
+                print(f'{asmfilename}: failed, {error}')
+                failed += 1
+        print(f'{len(timings) - failed} files assembled in {(time.perf_counter() - start) * 1000:.1f} ms')
+        if failed:
+            print(f'{failed} files failed')
+            sys.exit(1)
+    else:
+        assembleFile(asmfile, binary=binary, incremental=incremental)
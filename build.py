@@ -0,0 +1,83 @@
+import os, sys, time
+import JackCompiler, VM, assembler
+
+# To build a Jack program into machine code in one step:
+# Run the build with a .jack file (without its extension) or a directory of .jack files as the first command line
+# argument, the same way JackCompiler.py is run, e.g.
+#     python build.py Pong
+# Every class is compiled to VM code, the VM code is translated to assembly and the assembly is assembled, all in
+# memory in one process. Only Pong.hack is written, where the assembler would leave it after VM.py. .vm files in
+# the directory that have no .jack file (the compiled OS, for example) are part of the program as well.
+# Passing -b writes a binary ROM image (.rom) instead. -O, --trampolines, --shared-compare and --cache-tos are
+# passed on to the VM translator, see VM.py, and so are --dce, which leaves out the functions (of the OS, mostly) the
+# program never calls, and --inline, which replaces calls to small functions with their body. Passing --keep also
+# writes the intermediate files: a .vm file next to every .jack file and Pong.asm.
+
+def programClasses(inname):
+    # returns the names of the classes of the program inname, in translation order, the directory they are in and
+    # the set of classes that have a .jack file. a class with only a .vm file is taken as it is
+    jack_classes, directory = VM.programFiles(inname, '.jack')
+    vm_classes = []
+    if directory != '.':
+        vm_classes, directory = VM.programFiles(inname, '.vm')
+    classes = sorted(set(jack_classes) | set(vm_classes))
+    if 'Sys' in classes:
+        classes.remove('Sys')
+        classes.insert(0, 'Sys')
+    return classes, directory, set(jack_classes)
+
+def build(inname, optimize=False, trampolines=False, shared_compare=False, cache_tos=False, keep=False, dce=False,
+          inline=False):
+    # compiles, translates and assembles the program inname and returns its instruction words. with keep set the
+    # .vm file of every compiled class and the program's .asm file are written as well
+    classes, directory, jack_classes = programClasses(inname)
+    if len(classes) == 0:
+        raise Exception(f'No .jack files found for {inname}')
+
+    if cache_tos:
+        code_writer = VM.StackCachingCodeWriter(None, optimize, trampolines, shared_compare)
+    else:
+        code_writer = VM.CodeWriter(None, optimize, trampolines, shared_compare)
+    code_writer.writeInit()
+
+    parsers = []
+    for classname in classes:
+        path = os.path.join(directory, classname)
+        if classname in jack_classes:
+            vmcode = JackCompiler.compileFile(path, classname)
+            if keep:
+                vmfile = open(path + '.vm', 'w')
+                vmfile.write(vmcode)
+                vmfile.close()
+            parsers.append(VM.Parser(path, vmcode.split('\n')))
+        else:
+            parsers.append(VM.Parser(path))
+
+    VM.linkProgram(parsers, classes, dce, inline)
+    for classname, parser in zip(classes, parsers):
+        code_writer.setFileName(classname)
+        VM.translate(parser, code_writer)
+    code_writer.close()
+
+    assembly = code_writer.getvalue()
+    if keep:
+        asmfile = open(inname + '.asm', 'w')
+        asmfile.write(assembly)
+        asmfile.close()
+    return assembler.assemble(assembly)
+
+if __name__ == '__main__':
+    inname = sys.argv[1]
+    binary = '-b' in sys.argv[2:]
+    start = time.perf_counter()
+    words = build(inname, optimize='-O' in sys.argv[2:], trampolines='--trampolines' in sys.argv[2:],
+                  shared_compare='--shared-compare' in sys.argv[2:], cache_tos='--cache-tos' in sys.argv[2:],
+                  keep='--keep' in sys.argv[2:], dce='--dce' in sys.argv[2:],
+                  inline='--inline' in sys.argv[2:])
+    if binary:
+        outfilename = inname + '.rom'
+        assembler.writeRom(outfilename, words)
+    else:
+        outfilename = inname + '.hack'
+        assembler.writeHack(outfilename, words)
+    print(f'{len(words)} instructions written to {outfilename} in {(time.perf_counter() - start) * 1000:.1f} ms')
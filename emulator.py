@@ -0,0 +1,424 @@
+import sys, time, hashlib
+from array import array
+import assembler
+
+try:
+    import numpy
+except ImportError:
+    numpy = None # only needed for the RAM views, the emulator itself runs without it
+
+# To run a Hack program without the CPU emulator GUI:
+# Run the emulator with the path of a .hack file (text) or a .rom file (binary ROM image written by assembler.py -b)
+# as the first command line argument. An optional second argument limits the number of cycles to run, further
+# arguments of the form address=value set RAM before the program starts, e.g.
+#     python emulator.py Mult.hack 100000 0=6 1=7
+# The cycle count, the speed and RAM[0..15] are printed once the program halts or runs out of cycles.
+# Passing --jit runs the program as compiled basic blocks instead of interpreting it one instruction at a time.
+# Passing --check runs it both ways and stops with an error if the two end up with different registers, pc, cycle
+# count or RAM.
+#
+# The emulator can also be imported: CPU(loadRom('Prog.hack')).run(maxcycles) runs a program from a script.
+#
+# Basic block compilation: the ROM is cut into basic blocks, straight runs of instructions that end at a jump or
+# just before an address that might be jumped to. Every block is translated into the source of a Python function
+# that does the work of all its instructions and returns the registers and the next pc, and is compiled with
+# compile() the first time it runs. Compiled blocks are cached per ROM contents, so every CPU running the same
+# program shares them.
+
+ramsize = 32768 # the Hack computer has 15 address bits, RAM above the keyboard is never mapped to anything
+screenaddress = assembler.SymbolTable().getAddress('SCREEN')
+keyboardaddress = assembler.SymbolTable().getAddress('KBD')
+screenrows = 256
+screencolumns = 512
+
+def loadRom(filename):
+    # reads a program from a text .hack file or a binary ROM image and returns its instruction words
+    romfile = open(filename, 'rb')
+    start = romfile.read(17)
+    romfile.close()
+
+    # a text .hack file only contains 0, 1 and line breaks
+    if filename.endswith('.rom') or start.strip(b'01\r\n') != b'':
+        return assembler.readRom(filename)
+    hackfile = open(filename)
+    words = [int(line, 2) for line in hackfile if line.strip() != '']
+    hackfile.close()
+    return words
+
+def toSigned(value):
+    # wraps an integer to the range of a 16-bit two's complement word
+    return ((value + 32768) & 0xFFFF) - 32768
+
+def aluFunction(compbits):
+    # returns a function (D, A, M) -> value that computes the given 7 comp bits the way the Hack ALU does.
+    # used for comp codes that have no mnemonic in the assembler's table
+    usesm, zx, nx, zy, ny, f, no = [(compbits >> shift) & 1 for shift in range(6, -1, -1)]
+
+    def alu(D, A, M):
+        x = D
+        y = M if usesm else A
+        if zx:
+            x = 0
+        if nx:
+            x = ~x
+        if zy:
+            y = 0
+        if ny:
+            y = ~y
+        out = x + y if f else x & y
+        if no:
+            out = ~out
+        return out
+    return alu
+
+def compFunctions():
+    # builds a function (D, A, M) -> value for every one of the 128 comp codes. the results are not wrapped to 16
+    # bits, that is left to the caller
+    functions = {}
+    for mnemonic, bits in assembler.Code().comptable.items():
+        expression = mnemonic.replace('!', '~')
+        functions[int(bits, 2)] = eval(f'lambda D, A, M: {expression}')
+    for compbits in range(128):
+        if compbits not in functions:
+            functions[compbits] = aluFunction(compbits)
+    return functions
+
+# for each of the 8 jump codes: should the jump be taken when the ALU output is negative, zero, positive
+jumpconditions = [tuple(bool(jump & bit) for bit in (4, 2, 1)) for jump in range(8)]
+
+def predecode(words):
+    # turns instruction words into op tuples so the interpretation loop never has to pick bits out of a word.
+    # an A instruction becomes (False, value). a C instruction becomes (True, comp function, reads M,
+    # writes A, writes D, writes M, jump conditions or None)
+    comps = compFunctions()
+    ops = []
+    for word in words:
+        if word & 0x8000 == 0:
+            ops.append((False, word))
+        else:
+            compbits = (word >> 6) & 0x7F
+            jump = word & 7
+            ops.append((True, comps[compbits], bool(compbits & 0x40), bool(word & 0x20), bool(word & 0x10),
+                        bool(word & 0x08), jumpconditions[jump] if jump else None))
+    return ops
+
+# source of the expression computing each comp mnemonic, with X standing for the value of M
+compexpressions = {
+    '0': '0', '1': '1', '-1': '-1', 'D': 'D', 'A': 'A', '!D': '~D', '!A': '~A', '-D': '-D', '-A': '-A',
+    'D+1': 'D + 1', 'A+1': 'A + 1', 'D-1': 'D - 1', 'A-1': 'A - 1', 'D+A': 'D + A', 'D-A': 'D - A',
+    'A-D': 'A - D', 'D&A': 'D & A', 'D|A': 'D | A', 'M': 'X', '!M': '~X', '-M': '-X', 'M+1': 'X + 1',
+    'M-1': 'X - 1', 'D+M': 'D + X', 'D-M': 'D - X', 'M-D': 'X - D', 'D&M': 'D & X', 'D|M': 'D | X'
+}
+
+# source of the condition each jump code tests on the ALU output t
+jumpexpressions = [None, 't > 0', 't == 0', 't >= 0', 't < 0', 't != 0', 't <= 0', 'True']
+
+# compiled blocks of every ROM seen so far: ROM digest -> {start address: (function, length, halt address)}. the
+# halt address is where the block's last instruction, the jump of an (END) @END 0;JMP loop, would jump back to, or -1
+blockcache = {}
+
+def blockLeaders(words):
+    # returns the addresses where a basic block has to start: the first instruction, every instruction after a
+    # jump, and every address some A instruction loads, since any of those might be jumped to
+    leaders = {0}
+    for address, word in enumerate(words):
+        if word & 0x8000 == 0:
+            if word < len(words):
+                leaders.add(word)
+        elif word & 7:
+            leaders.add(address + 1)
+    return leaders
+
+def blockSource(words, start, leaders, comps):
+    # translates the basic block starting at start into the source of a function block(A, D, ram) -> (A, D, pc).
+    # returns the source, the number of instructions in the block and the comp functions the source refers to by
+    # name (for comp codes that have no mnemonic).
+    # A is only assigned when its value isn't known while translating: after @value every use of A and M is
+    # translated with the constant address, and the constant is returned as A at the end of the block
+    mnemonics = {int(bits, 2): mnemonic for mnemonic, bits in assembler.Code().comptable.items()}
+    lines = ['def block(A, D, ram):']
+    needed = {}
+    knowna = None # value of A when it is known at translation time
+    pc = start
+    exits = False
+
+    while pc < len(words):
+        word = words[pc]
+        pc += 1
+        if word & 0x8000 == 0:
+            knowna = word
+        else:
+            compbits = (word >> 6) & 0x7F
+            jump = word & 7
+            avalue = 'A' if knowna is None else str(knowna)
+            address = 'A & 32767' if knowna is None else str(knowna)
+
+            if compbits in mnemonics:
+                expression = compexpressions[mnemonics[compbits]]
+                expression = expression.replace('A', avalue).replace('X', f'ram[{address}]')
+                if '+' in expression or '-' in expression and expression != '-1':
+                    expression = f'(({expression}) + 32768 & 65535) - 32768'
+            else:
+                name = f'alu{compbits}'
+                needed[name] = comps[compbits]
+                expression = f'(({name}(D, {avalue}, ram[{address}])) + 32768 & 65535) - 32768'
+
+            destinations = []
+            if word & 0x08:
+                destinations.append(f'ram[{address}]')
+            if word & 0x10:
+                destinations.append('D')
+            if jump and word & 0x20 and knowna is None:
+                lines.append('    j = A & 32767')
+                address = 'j'
+            if word & 0x20:
+                destinations.append('A')
+                knowna = None
+
+            if len(destinations) == 1 and not jump:
+                lines.append(f'    {destinations[0]} = {expression}')
+            elif destinations or jump:
+                lines.append(f'    t = {expression}')
+                for destination in destinations:
+                    lines.append(f'    {destination} = t')
+
+            if jump:
+                avalue = 'A' if knowna is None else str(knowna)
+                if jump == 7:
+                    lines.append(f'    return {avalue}, D, {address}')
+                else:
+                    lines.append(f'    if {jumpexpressions[jump]}:')
+                    lines.append(f'        return {avalue}, D, {address}')
+                    lines.append(f'    return {avalue}, D, {pc}')
+                exits = True
+                break
+        if pc in leaders:
+            break
+
+    if not exits:
+        lines.append(f'    return {"A" if knowna is None else knowna}, D, {pc}')
+    return '\n'.join(lines) + '\n', pc - start, needed
+
+def needNumpy():
+    if numpy is None:
+        raise Exception('NumPy is needed for RAM views and snapshots, install it with pip install numpy')
+
+def ramDiff(before, after):
+    # compares two RAM snapshots (or views) and returns the addresses whose words differ, with the words before and
+    # after at those addresses, as three NumPy arrays
+    needNumpy()
+    addresses = numpy.flatnonzero(before != after)
+    return addresses, before[addresses], after[addresses]
+
+def screenBitmap(screenwords):
+    # unpacks the 8K words of the screen memory map into a 256x512 array of pixels (1 is black). pixel (row, column)
+    # is bit column % 16 of word row * 32 + column // 16, so the bits of each word are unpacked low bit first
+    needNumpy()
+    screenbytes = numpy.asarray(screenwords, dtype='<u2').view(numpy.uint8)
+    return numpy.unpackbits(screenbytes, bitorder='little').reshape(screenrows, screencolumns)
+
+class CPU:
+    def __init__(self, words, jit=False):
+        # loads a program given as its instruction words and resets the computer. with jit set the program is run
+        # as compiled basic blocks
+        self.rom = list(words)
+        self.ops = predecode(self.rom)
+        self.ram = array('h', bytes(2 * ramsize))
+        self.jit = jit
+        self.leaders = None
+        self.comps = None
+        if jit:
+            digest = hashlib.blake2b(array('H', self.rom).tobytes(), digest_size=16).digest()
+            self.blocks = blockcache.setdefault(digest, {})
+        self.reset()
+
+    def reset(self):
+        # resets the registers and cycle count. RAM keeps its contents, like pressing reset on the real machine
+        self.A = 0
+        self.D = 0
+        self.pc = 0
+        self.cycles = 0
+        self.halted = False
+
+    def ramView(self):
+        # returns RAM as a NumPy uint16 array that shares memory with the emulator: no copy is made and it always
+        # shows the current contents. writing to it writes to RAM
+        needNumpy()
+        return numpy.frombuffer(self.ram, dtype=numpy.uint16)
+
+    def screenView(self):
+        # returns the screen memory map as a NumPy uint16 array sharing memory with the emulator
+        return self.ramView()[screenaddress:keyboardaddress]
+
+    def snapshot(self, start=0, end=ramsize):
+        # returns a copy of RAM[start:end] as a NumPy uint16 array, to compare with ramDiff later
+        return self.ramView()[start:end].copy()
+
+    def screen(self):
+        # returns what is on the screen right now as a 256x512 array of pixels
+        return screenBitmap(self.screenView())
+
+    def isHaltLoop(self, pc):
+        # checks if the instructions at pc are the usual end of a program, an unconditional jump to itself that
+        # changes nothing on the way: (END) @END 0;JMP
+        ops = self.ops
+        return (pc + 1 < len(ops) and ops[pc] == (False, pc) and ops[pc + 1][0]
+                and ops[pc + 1][6] == (True, True, True) and not any(ops[pc + 1][3:6]))
+
+    def step(self):
+        # executes a single instruction
+        return self.interpret(1)
+
+    def run(self, maxcycles=None):
+        # executes instructions until the program halts or maxcycles instructions have been executed, returns the
+        # number of instructions executed. a program has halted when it enters the (END) @END 0;JMP loop or runs off
+        # the end of the ROM
+        if self.jit:
+            return self.runBlocks(maxcycles)
+        return self.interpret(maxcycles)
+
+    def compileBlock(self, start):
+        # compiles the basic block starting at start and adds it to the block cache
+        if self.leaders is None:
+            self.leaders = blockLeaders(self.rom)
+            self.comps = compFunctions()
+        source, length, needed = blockSource(self.rom, start, self.leaders, self.comps)
+        namespace = dict(needed)
+        exec(compile(source, f'<hack block {start}>', 'exec'), namespace)
+        # the halt loop's @END may be in an earlier block when END + 1 is a leader, so look at the jump that ends this
+        # block rather than at where the block starts
+        end = start + length - 2
+        block = (namespace['block'], length, end if end >= 0 and self.isHaltLoop(end) else -1)
+        self.blocks[start] = block
+        return block
+
+    def runBlocks(self, maxcycles=None):
+        # runs the program a compiled basic block at a time. the last few instructions before maxcycles that don't
+        # make up a whole block are interpreted
+        if maxcycles is None:
+            maxcycles = float('inf')
+        blocks = self.blocks
+        ram = self.ram
+        romsize = len(self.rom)
+        A = self.A
+        D = self.D
+        pc = self.pc
+        cycles = 0
+
+        while True:
+            # the cycle budget is checked first, in the same order as interpret(), so a program that leaves the ROM
+            # on its last allowed cycle has stopped rather than halted either way
+            if cycles >= maxcycles:
+                break
+            if pc >= romsize:
+                self.halted = True
+                break
+            block = blocks.get(pc)
+            if block is None:
+                block = self.compileBlock(pc)
+            function, length, haltaddress = block
+            if cycles + length > maxcycles:
+                self.A, self.D, self.pc = A, D, pc
+                self.cycles += cycles
+                return cycles + self.interpret(maxcycles - cycles)
+            A, D, nextpc = function(A, D, ram)
+            cycles += length
+            pc = nextpc
+            if pc == haltaddress:
+                self.halted = True
+                break
+
+        self.A = A
+        self.D = D
+        self.pc = pc
+        self.cycles += cycles
+        return cycles
+
+    def interpret(self, maxcycles=None):
+        # executes instructions one at a time, see run()
+        if maxcycles is None:
+            maxcycles = float('inf')
+        ops = self.ops
+        ram = self.ram
+        romsize = len(ops)
+        A = self.A
+        D = self.D
+        pc = self.pc
+        cycles = 0
+
+        while cycles < maxcycles:
+            if pc >= romsize:
+                self.halted = True
+                break
+            op = ops[pc]
+            cycles += 1
+            if not op[0]:
+                A = op[1]
+                pc += 1
+                continue
+
+            _, comp, usesm, writesa, writesd, writesm, jump = op
+            out = comp(D, A, ram[A & 0x7FFF] if usesm else 0)
+            if out > 32767 or out < -32768:
+                out = ((out + 32768) & 0xFFFF) - 32768
+            if writesm:
+                ram[A & 0x7FFF] = out
+            if writesd:
+                D = out
+            if jump is not None and jump[0 if out < 0 else 1 if out == 0 else 2]:
+                target = A & 0x7FFF
+                if target == pc - 1 and self.isHaltLoop(target):
+                    self.halted = True
+                    pc = target
+                    if writesa:
+                        A = out
+                    break
+                pc = target
+            else:
+                pc += 1
+            if writesa:
+                A = out
+
+        self.A = A
+        self.D = D
+        self.pc = pc
+        self.cycles += cycles
+        return cycles
+
+def checkJit(words, maxcycles=None, ram=None):
+    # runs a program interpreted and as compiled basic blocks, both starting from a copy of ram, and raises an
+    # Exception if they end in a different state. returns the interpreting CPU
+    interpreted = CPU(words)
+    compiled = CPU(words, jit=True)
+    if ram is not None:
+        interpreted.ram = array('h', ram)
+        compiled.ram = array('h', ram)
+    interpreted.run(maxcycles)
+    compiled.run(maxcycles)
+    for name in ('pc', 'cycles', 'halted', 'A', 'D', 'ram'):
+        if getattr(interpreted, name) != getattr(compiled, name):
+            raise Exception(f'--jit and the interpreter disagree on {name}')
+    return interpreted
+
+if __name__ == '__main__':
+    cpu = CPU(loadRom(sys.argv[1]), jit='--jit' in sys.argv[2:])
+    maxcycles = None
+    for argument in sys.argv[2:]:
+        if argument == '--jit' or argument == '--check':
+            continue
+        if '=' in argument:
+            address, value = argument.split('=')
+            cpu.ram[int(address)] = toSigned(int(value))
+        else:
+            maxcycles = int(argument)
+
+    start = time.perf_counter()
+    if '--check' in sys.argv[2:]:
+        cpu = checkJit(cpu.rom, maxcycles, cpu.ram)
+    else:
+        cpu.run(maxcycles)
+    seconds = time.perf_counter() - start
+
+    print(f'{"halted" if cpu.halted else "stopped"} after {cpu.cycles} cycles in {seconds:.3f} s '
+          f'({cpu.cycles / max(seconds, 1e-9) / 1e6:.2f} M instructions/s)')
+    print(' '.join(f'R{address}={cpu.ram[address]}' for address in range(16)))
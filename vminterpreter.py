@@ -0,0 +1,289 @@
+import os, sys, time
+from array import array
+import VM, emulator
+from emulator import ramsize, toSigned
+
+# To run a VM program directly, without translating it to assembly and assembling it:
+# Run the interpreter with a .vm file (without its extension) or a directory of .vm files as the first command line
+# argument, the same way VM.py is run. An optional second argument limits the number of VM commands to execute,
+# further arguments of the form address=value set RAM before the program starts, e.g.
+#     python vminterpreter.py FibonacciElement 1000000
+# The number of commands executed and RAM[0..15] are printed when the program ends or runs out of steps.
+#
+# The program is loaded with VM.Parser and resolved once into integer bytecode: labels and functions become
+# indexes into the bytecode, segments with a fixed address (temp, pointer, static) become addresses. The commands
+# then work on a RAM laid out exactly like the translated program's: the stack starts at 256, SP, LCL, ARG, THIS and
+# THAT live in RAM[0..4], temp in RAM[5..12] and statics from RAM[16] up, allocated in the order the assembler would
+# allocate them. Return addresses are bytecode indexes, which may not fit in a RAM word, so they are kept on a
+# separate list: call pushes the return address's position on that list (the call depth) instead of a ROM address.
+# If the program has a Sys.init function it is bootstrapped like VM.py does (SP = 256, call Sys.init), otherwise
+# execution starts at the first command with RAM as it is.
+
+# bytecode opcodes
+PUSH_CONSTANT, PUSH_SEGMENT, PUSH_ADDRESS, POP_SEGMENT, POP_ADDRESS = range(5)
+ADD, SUB, NEG, EQ, GT, LT, AND, OR, NOT = range(5, 14)
+GOTO, IF_GOTO, FUNCTION, CALL, RETURN, HALT = range(14, 20)
+
+arithmetic_opcodes = {'add': ADD, 'sub': SUB, 'neg': NEG, 'eq': EQ, 'gt': GT, 'lt': LT, 'and': AND, 'or': OR,
+                      'not': NOT}
+segment_registers = {'local': 1, 'argument': 2, 'this': 3, 'that': 4} # RAM address of each segment's base
+fixed_segments = {'temp': 5, 'pointer': 3}
+
+class Program:
+    def __init__(self):
+        # bytecode of a VM program being loaded: a list of (opcode, a, b) tuples
+        self.bytecode = []
+        self.functions = {}   # function name -> bytecode index
+        self.labels = {}      # function$label -> bytecode index
+        self.statics = {}     # file.index -> RAM address
+        self.fixups = []      # (bytecode index, label or function name) still to be resolved
+        self.next_static_address = 16
+
+    def staticAddress(self, filename, index):
+        # allocates statics in order of first use, like the assembler allocates variables
+        symbol = f'{filename}.{index}'
+        if symbol not in self.statics:
+            self.statics[symbol] = self.next_static_address
+            self.next_static_address += 1
+        return self.statics[symbol]
+
+    def addFile(self, parser, filename):
+        # compiles every command of a parsed .vm file into bytecode
+        bytecode = self.bytecode
+        label_prefix = '$'
+        while parser.hasMoreCommands():
+            parser.advance()
+            commandType = parser.commandType()
+
+            if commandType == 'C_ARITHMETIC':
+                bytecode.append((arithmetic_opcodes[parser.arg1()], 0, 0))
+            elif commandType == 'C_PUSH' or commandType == 'C_POP':
+                segment = parser.arg1()
+                index = parser.arg2()
+                if segment == 'constant':
+                    if commandType == 'C_POP':
+                        raise Exception('Can not pop to the constant segment')
+                    bytecode.append((PUSH_CONSTANT, index, 0))
+                    continue
+                if segment in segment_registers:
+                    opcode = PUSH_SEGMENT if commandType == 'C_PUSH' else POP_SEGMENT
+                    bytecode.append((opcode, segment_registers[segment], index))
+                    continue
+                if segment in fixed_segments:
+                    address = fixed_segments[segment] + index
+                elif segment == 'static':
+                    address = self.staticAddress(filename, index)
+                else:
+                    raise Exception('Push Pop Command Not Found')
+                opcode = PUSH_ADDRESS if commandType == 'C_PUSH' else POP_ADDRESS
+                bytecode.append((opcode, address, 0))
+
+            elif commandType == 'C_LABEL':
+                self.labels[label_prefix + parser.arg1()] = len(bytecode)
+            elif commandType == 'C_GOTO' or commandType == 'C_IF':
+                self.fixups.append((len(bytecode), label_prefix + parser.arg1()))
+                bytecode.append((GOTO if commandType == 'C_GOTO' else IF_GOTO, None, 0))
+
+            elif commandType == 'C_FUNCTION':
+                functionName = parser.arg1()
+                label_prefix = functionName + '$'
+                self.functions[functionName] = len(bytecode)
+                bytecode.append((FUNCTION, parser.arg2(), 0))
+            elif commandType == 'C_CALL':
+                self.fixups.append((len(bytecode), parser.arg1()))
+                bytecode.append((CALL, None, parser.arg2()))
+            elif commandType == 'C_RETURN':
+                bytecode.append((RETURN, 0, 0))
+
+    def link(self):
+        # resolves every label and function name into a bytecode index and ends the program with a HALT that
+        # execution reaches if it runs off the end (or if Sys.init returns)
+        for position, name in self.fixups:
+            opcode, target, b = self.bytecode[position]
+            if opcode == CALL:
+                if name not in self.functions:
+                    raise Exception(f'Function {name} is not defined')
+                target = self.functions[name]
+            else:
+                if name not in self.labels:
+                    raise Exception(f'Label {name} is not defined')
+                target = self.labels[name]
+            self.bytecode[position] = (opcode, target, b)
+        self.fixups = []
+        self.bytecode.append((HALT, 0, 0))
+
+def loadProgram(inname):
+    # loads a .vm file (without its extension) or a directory of .vm files, in the same order VM.py translates them
+    vm_program_folder, directory = VM.programFiles(inname)
+    program = Program()
+    for infile in vm_program_folder:
+        program.addFile(VM.Parser(os.path.join(directory, infile)), infile)
+    program.link()
+    return program
+
+class VMInterpreter:
+    def __init__(self, program):
+        # gets ready to run a loaded Program
+        self.program = program
+        self.bytecode = program.bytecode
+        self.ram = array('h', bytes(2 * ramsize))
+        self.pc = 0
+        self.steps = 0
+        self.halted = False
+        self.returnaddresses = [] # bytecode index to return to for every call in progress
+
+    def bootstrap(self):
+        # sets SP to 256 and calls Sys.init, pushing the same frame the translated bootstrap code pushes.
+        # Sys.init returns to the final HALT
+        ram = self.ram
+        ram[0] = 256
+        self.push(len(self.returnaddresses))
+        self.returnaddresses.append(len(self.bytecode) - 1)
+        for register in (1, 2, 3, 4):
+            self.push(ram[register])
+        ram[2] = ram[0] - 5
+        ram[1] = ram[0]
+        self.pc = self.program.functions['Sys.init']
+
+    def push(self, value):
+        ram = self.ram
+        ram[ram[0]] = value
+        ram[0] += 1
+
+    def ramView(self):
+        # returns RAM as a NumPy uint16 array sharing memory with the interpreter
+        emulator.needNumpy()
+        return emulator.numpy.frombuffer(self.ram, dtype=emulator.numpy.uint16)
+
+    def run(self, maxsteps=None):
+        # executes VM commands until the program ends or maxsteps commands have been executed, returns the number of
+        # commands executed
+        if maxsteps is None:
+            maxsteps = float('inf')
+        bytecode = self.bytecode
+        ram = self.ram
+        returnaddresses = self.returnaddresses
+        pc = self.pc
+        steps = 0
+
+        while steps < maxsteps:
+            opcode, a, b = bytecode[pc]
+            pc += 1
+            steps += 1
+
+            if opcode == PUSH_CONSTANT:
+                sp = ram[0]
+                ram[sp] = a
+                ram[0] = sp + 1
+            elif opcode == PUSH_SEGMENT:
+                sp = ram[0]
+                ram[sp] = ram[(ram[a] + b) & 0x7FFF]
+                ram[0] = sp + 1
+            elif opcode == PUSH_ADDRESS:
+                sp = ram[0]
+                ram[sp] = ram[a]
+                ram[0] = sp + 1
+            elif opcode == POP_SEGMENT:
+                sp = ram[0] - 1
+                ram[0] = sp
+                ram[(ram[a] + b) & 0x7FFF] = ram[sp]
+            elif opcode == POP_ADDRESS:
+                sp = ram[0] - 1
+                ram[0] = sp
+                ram[a] = ram[sp]
+
+            elif opcode <= NOT:
+                sp = ram[0]
+                if opcode == NEG:
+                    ram[sp - 1] = toSigned(-ram[sp - 1])
+                    continue
+                if opcode == NOT:
+                    ram[sp - 1] = ~ram[sp - 1]
+                    continue
+                y = ram[sp - 1]
+                x = ram[sp - 2]
+                ram[0] = sp - 1
+                if opcode == ADD:
+                    value = toSigned(x + y)
+                elif opcode == SUB:
+                    value = toSigned(x - y)
+                elif opcode == AND:
+                    value = x & y
+                elif opcode == OR:
+                    value = x | y
+                elif opcode == EQ:
+                    value = -1 if x == y else 0
+                elif opcode == GT:
+                    # the translated code compares by subtracting, which wraps around for far apart values
+                    value = -1 if toSigned(x - y) > 0 else 0
+                else:
+                    value = -1 if toSigned(x - y) < 0 else 0
+                ram[sp - 2] = value
+
+            elif opcode == GOTO:
+                pc = a
+            elif opcode == IF_GOTO:
+                sp = ram[0] - 1
+                ram[0] = sp
+                if ram[sp] != 0:
+                    pc = a
+            elif opcode == FUNCTION:
+                sp = ram[0]
+                for i in range(a):
+                    ram[sp + i] = 0
+                ram[0] = sp + a
+            elif opcode == CALL:
+                sp = ram[0]
+                ram[sp] = len(returnaddresses)
+                returnaddresses.append(pc)
+                ram[sp + 1] = ram[1]
+                ram[sp + 2] = ram[2]
+                ram[sp + 3] = ram[3]
+                ram[sp + 4] = ram[4]
+                ram[2] = sp - b
+                ram[1] = sp + 5
+                ram[0] = sp + 5
+                pc = a
+            elif opcode == RETURN:
+                frame = ram[1]
+                depth = ram[frame - 5]
+                returnaddress = returnaddresses[depth]
+                del returnaddresses[depth:]
+                argument = ram[2]
+                ram[argument] = ram[ram[0] - 1]
+                ram[0] = argument + 1
+                ram[4] = ram[frame - 1]
+                ram[3] = ram[frame - 2]
+                ram[2] = ram[frame - 3]
+                ram[1] = ram[frame - 4]
+                pc = returnaddress
+            else:
+                self.halted = True
+                pc -= 1
+                steps -= 1
+                break
+
+        self.pc = pc
+        self.steps += steps
+        return steps
+
+if __name__ == '__main__':
+    program = loadProgram(sys.argv[1])
+    interpreter = VMInterpreter(program)
+    maxsteps = None
+    for argument in sys.argv[2:]:
+        if '=' in argument:
+            address, value = argument.split('=')
+            interpreter.ram[int(address)] = toSigned(int(value))
+        else:
+            maxsteps = int(argument)
+    if 'Sys.init' in program.functions:
+        interpreter.bootstrap()
+
+    start = time.perf_counter()
+    interpreter.run(maxsteps)
+    seconds = time.perf_counter() - start
+
+    print(f'{"ended" if interpreter.halted else "stopped"} after {interpreter.steps} commands in {seconds:.3f} s '
+          f'({interpreter.steps / max(seconds, 1e-9) / 1e6:.2f} M commands/s)')
+    print(' '.join(f'R{address}={interpreter.ram[address]}' for address in range(16)))